@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks on synthetic corpora shaped like the ones used in the configs.
+
+The suite runs every case in a fresh process and writes the timings,
+throughput and peak RSS as JSON. Two result files can be compared to find
+regressions, compare exits with status 1 if there are any.
+
+usage: python benchmark.py suite [--output FILE] [--scale F] [--repeat N] [--cases PREFIX]
+       python benchmark.py compare OLD NEW [--threshold F]
+       python benchmark.py nested [--documents N] [--tokens N]
+       python benchmark.py streaming [--documents N] [--tokens N]
+       python benchmark.py analytic [--documents N] [--tokens N] [--samples N]
+       python benchmark.py tokenizer [--documents N] [--tokens N] [--repeat N]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+
+from dataloader import DEFAULT_BOGDANOVA_PATTERN_CHUNKS, DEFAULT_LLORENS_PATTERN, NovelsCrossValidator
+from feature_extraction import LifeVectorizer, token_ids
+from memory import peak_rss
+from pipeline_tools import CustomCallbackTransformer, DictFieldTransformer, FileReader, JsonFieldReader, JsonTransformer, Tokenizer
+
+LLORENS_FRAGMENT_SIZES = [200, 500, 800, 1000, 1500, 2000, 3000, 4000]
+
+# the shape of the corpora and the largest and smallest fragment size lists
+# of their configs. Reddit posts are passed to the LifeVectorizer as strings,
+# so their tokens are characters.
+CORPORA = {
+    'llorens': {
+        'documents': 10,
+        'tokens': 80000,
+        'samples': 200,
+        'fragment_sizes': [LLORENS_FRAGMENT_SIZES, [200]],
+    },
+    'bogdanova': {
+        'documents': 200,
+        'tokens': 2000,
+        'samples': 200,
+        'fragment_sizes': [[100, 200, 500, 800, 1000, 1500], [100, 200]],
+    },
+    'reddit': {
+        'documents': 500,
+        'tokens': 1000,
+        'samples': 20,
+        'fragment_sizes': [[50, 100, 200], [50]],
+    },
+}
+CV_FILES = [500, 2000, 8000]
+
+
+def synthetic_documents(n_documents, n_tokens, vocabulary_size=30000, seed=0):
+    """Zipf-distributed token lists, roughly the shape of a tokenized novel."""
+    rng = np.random.default_rng(seed)
+    words = np.array([f'w{i}' for i in range(vocabulary_size)])
+    return [
+        words[(rng.zipf(1.2, n_tokens) - 1) % vocabulary_size].tolist()
+        for _ in range(n_documents)
+    ]
+
+
+def synthetic_texts(n_documents, n_tokens, seed=0):
+    """Zipf-distributed texts of words between 1 and 12 letters."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyzäöüñé'))
+    words = np.array([
+        ''.join(rng.choice(letters, length))
+        for length in rng.integers(1, 13, 30000)
+    ])
+    return [
+        ' '.join(words[(rng.zipf(1.2, n_tokens) - 1) % len(words)])
+        for _ in range(n_documents)
+    ]
+
+
+def synthetic_reddit_corpus(directory, n_documents, n_characters, seed=0):
+    """Writes reddit-like JSON posts and returns their paths."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz     '))
+    paths = []
+    for i in range(n_documents):
+        path = os.path.join(directory, f'{i}.json')
+        with open(path, 'w') as o_f:
+            json.dump({
+                'id': str(i),
+                'author': 'someone',
+                'subreddit': 'de',
+                'score': int(rng.integers(100)),
+                'body': ''.join(rng.choice(letters, n_characters)),
+            }, o_f)
+        paths.append(path)
+    return paths
+
+
+def synthetic_posts(n_documents, n_characters, seed=0):
+    """Character lists, like the bodies of reddit posts."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz     '))
+    return [rng.choice(letters, n_characters).tolist() for _ in range(n_documents)]
+
+
+def synthetic_paths(n_files, chunks):
+    """
+    File names as listed by the novels loaders: 20 authors writing in 3
+    languages, with 10 chunks per work if chunks is set.
+    """
+    paths = []
+    per_work = 10 if chunks else 1
+    for i in range(n_files // per_work):
+        author, language, title = f'author{i % 20}', ['en', 'de', 'es'][i // 20 % 3], f'title{i // 60}'
+        for c in range(per_work):
+            if chunks:
+                paths.append(f'/corpus/{author}/{language}/chunks/{c:02d}_{title}_{c:03d}.txt')
+            else:
+                paths.append(f'/corpus/{author}/{language}/{title}.txt')
+    return paths
+
+
+def time_transform(vectorizer, documents, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vectorizer.transform(documents)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_nested(args):
+    documents = synthetic_documents(args.documents, args.tokens)
+    print(f'{args.documents} documents with {args.tokens} tokens, '
+          f'fragment sizes: {LLORENS_FRAGMENT_SIZES}')
+    print(f'{"sample_type":<12}{"independent":>14}{"nested":>10}{"speedup":>10}')
+    for sample_type in ['fragment', 'bow', 'both']:
+        times = [
+            time_transform(LifeVectorizer(
+                fragment_sizes=LLORENS_FRAGMENT_SIZES,
+                sample_type=sample_type,
+                nested=nested,
+            ), documents, args.repeat)
+            for nested in [False, True]
+        ]
+        print(f'{sample_type:<12}{times[0]:>13.2f}s{times[1]:>9.2f}s{times[0] / times[1]:>9.1f}x')
+
+
+def benchmark_streaming(args):
+    print(f'reddit-like corpus with {args.tokens} characters per post, '
+          'peak traced memory of FileReader -> JsonTransformer -> DictFieldTransformer -> LifeVectorizer')
+    print(f'{"documents":<12}{"eager":>12}{"lazy":>12}')
+    for n_documents in [args.documents, 4 * args.documents]:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = synthetic_reddit_corpus(directory, n_documents, args.tokens)
+            peaks = []
+            for lazy in [False, True]:
+                pipeline = Pipeline([
+                    ('filereader', FileReader(lazy=lazy)),
+                    ('json', JsonTransformer(lazy=lazy)),
+                    ('text', DictFieldTransformer('body', lazy=lazy)),
+                    ('life', LifeVectorizer(fragment_sizes=[50, 100, 200], samples=20, random_state=0)),
+                ])
+                tracemalloc.start()
+                pipeline.fit_transform(paths)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        print(f'{n_documents:<12}{peaks[0] / 2 ** 20:>10.1f}MB{peaks[1] / 2 ** 20:>10.1f}MB')
+
+
+def benchmark_analytic(args):
+    """
+    Compares the exact 'bow' statistics to the Monte Carlo estimates. With
+    s samples, the relative error of a Monte Carlo mean/std ratio is at
+    least about 1 / sqrt(2s), the means are usually far more precise.
+    """
+    documents = synthetic_documents(args.documents, args.tokens)
+    vectorizers = {
+        'analytic': LifeVectorizer(fragment_sizes=LLORENS_FRAGMENT_SIZES, analytic=True),
+        'monte carlo': LifeVectorizer(fragment_sizes=LLORENS_FRAGMENT_SIZES, samples=args.samples, random_state=0),
+    }
+    features = {}
+    for name, vectorizer in vectorizers.items():
+        start = time.perf_counter()
+        features[name] = vectorizer.transform(documents)
+        print(f'{name:<12}{time.perf_counter() - start:>9.2f}s')
+    deviation = np.abs(features['analytic'] - features['monte carlo']) / np.abs(features['monte carlo'])
+    deviation = deviation.reshape(len(documents), len(LLORENS_FRAGMENT_SIZES), 8)
+    print(f'largest relative deviation per fragment size ({args.samples} Monte Carlo samples):')
+    print(f'{"size":<8}' + ''.join(f'{name:>10}' for name in ['v0', 'v1', 'v2', 'v3', 'v0 ratio', 'v1 ratio', 'v2 ratio', 'v3 ratio']))
+    for size, row in zip(LLORENS_FRAGMENT_SIZES, deviation.max(axis=0)):
+        print(f'{size:<8}' + ''.join(f'{value:>10.4f}' for value in row))
+
+
+def benchmark_tokenizer(args):
+    """
+    Compares splitting texts and converting the token lists to ids, as the
+    LifeVectorizer does, with the Tokenizer, whose ids it takes as they are.
+    """
+    texts = synthetic_texts(args.documents, args.tokens)
+    splitter = CustomCallbackTransformer(lambda x: x.split())
+    tokenizer = Tokenizer(memo_bytes=0)
+    memoized = Tokenizer()
+    memoized.transform(texts)
+    times = {
+        'split': best_time(lambda: [token_ids(tokens) for tokens in splitter.transform(texts)], args.repeat),
+        'tokenizer': best_time(lambda: [token_ids(ids) for ids in tokenizer.transform(texts)], args.repeat),
+        'memoized': best_time(lambda: [token_ids(ids) for ids in memoized.transform(texts)], args.repeat),
+    }
+    print(f'{args.documents} texts with {args.tokens} tokens')
+    for name, seconds in times.items():
+        print(f'{name:<12}{seconds:>9.3f}s{times["split"] / seconds:>9.1f}x')
+    for name, transformer in [('split', splitter), ('tokenizer', tokenizer)]:
+        tracemalloc.start()
+        output = transformer.transform(texts)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del output
+        print(f'{name:<12}{peak / 2 ** 20:>9.1f}MB peak while tokenizing')
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def case_life(corpus, sample_type, fragment_sizes, analytic, scale, repeat):
+    shape = CORPORA[corpus]
+    n_documents = max(1, int(shape['documents'] * scale))
+    if corpus == 'reddit':
+        documents = synthetic_posts(n_documents, shape['tokens'])
+    else:
+        documents = synthetic_documents(n_documents, shape['tokens'])
+    vectorizer = LifeVectorizer(
+        fragment_sizes=fragment_sizes,
+        samples=shape['samples'],
+        sample_type=sample_type,
+        random_state=0,
+        analytic=analytic,
+    )
+    return {
+        'seconds': best_time(lambda: vectorizer.transform(documents), repeat),
+        'documents': n_documents,
+        'tokens': sum(len(d) for d in documents),
+    }
+
+
+def case_cv(n_files, chunks, scale, repeat):
+    paths = synthetic_paths(max(10, int(n_files * scale)), chunks)
+    pattern = DEFAULT_BOGDANOVA_PATTERN_CHUNKS if chunks else DEFAULT_LLORENS_PATTERN
+
+    def run():
+        # a new validator every time, it keeps the splits of the last files
+        cv = NovelsCrossValidator(pattern, chunks, strict_languages=True, strict_titles=True)
+        cv.get_n_splits(paths)
+        list(cv.split(paths))
+    return {
+        'seconds': best_time(run, repeat),
+        'documents': len(paths),
+        'tokens': 0,
+    }
+
+
+def case_tokenizer(corpus, tokenizer, scale, repeat):
+    shape = CORPORA[corpus]
+    n_documents = max(1, int(shape['documents'] * scale))
+    texts = synthetic_texts(n_documents, shape['tokens'])
+    if tokenizer == 'split':
+        transformer = CustomCallbackTransformer(lambda x: x.split())
+    else:
+        transformer = Tokenizer(memo_bytes=0)
+    # including the conversion of the LifeVectorizer
+    return {
+        'seconds': best_time(lambda: [token_ids(tokens) for tokens in transformer.transform(texts)], repeat),
+        'documents': n_documents,
+        'tokens': n_documents * shape['tokens'],
+    }
+
+
+def case_reader(reader, scale, repeat):
+    shape = CORPORA['reddit']
+    n_documents = max(1, int(shape['documents'] * scale))
+    with tempfile.TemporaryDirectory() as directory:
+        paths = synthetic_reddit_corpus(directory, n_documents, shape['tokens'])
+        if reader == 'chain':
+            pipeline = Pipeline([
+                ('filereader', FileReader()),
+                ('json', JsonTransformer()),
+                ('text', DictFieldTransformer('body')),
+            ])
+        else:
+            pipeline = JsonFieldReader('body')
+        return {
+            'seconds': best_time(lambda: pipeline.fit_transform(paths), repeat),
+            'documents': n_documents,
+            'tokens': n_documents * shape['tokens'],
+        }
+
+
+def suite_cases():
+    """Returns (name, function, arguments) of every case of the suite."""
+    cases = []
+    for corpus, shape in CORPORA.items():
+        for sample_type in ['fragment', 'bow', 'both']:
+            for sizes in shape['fragment_sizes']:
+                name = f'life/{corpus}/{sample_type}/{len(sizes)}-sizes'
+                cases.append((name, case_life, (corpus, sample_type, sizes, False)))
+        sizes = shape['fragment_sizes'][0]
+        cases.append((f'life/{corpus}/bow-analytic/{len(sizes)}-sizes', case_life, (corpus, 'bow', sizes, True)))
+    for chunks in [False, True]:
+        for n_files in CV_FILES:
+            name = f'cv/{"chunks" if chunks else "novels"}/{n_files}-files'
+            cases.append((name, case_cv, (n_files, chunks)))
+    for reader in ['chain', 'json_field_reader']:
+        cases.append((f'reader/{reader}', case_reader, (reader,)))
+    for corpus in ['llorens', 'bogdanova']:
+        for tokenizer in ['split', 'tokenizer']:
+            cases.append((f'tokenizer/{corpus}/{tokenizer}', case_tokenizer, (corpus, tokenizer)))
+    return cases
+
+
+def run_case(function, arguments, scale, repeat):
+    """Runs in a fresh process, so that the peak RSS is the one of the case."""
+    result = function(*arguments, scale, repeat)
+    result['peak_rss_mb'] = peak_rss() / 2 ** 20
+    return result
+
+
+def benchmark_suite(args):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name, function, arguments in suite_cases():
+        if args.cases and not name.startswith(args.cases):
+            continue
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run_case, function, arguments, args.scale, args.repeat).result()
+        result['name'] = name
+        result['documents_per_second'] = result['documents'] / result['seconds']
+        result['tokens_per_second'] = result['tokens'] / result['seconds']
+        results.append(result)
+        print(f'{name:<36}{result["seconds"]:>9.3f}s{result["documents_per_second"]:>12.1f} docs/s'
+              f'{result["tokens_per_second"]:>14.0f} tokens/s{result["peak_rss_mb"]:>9.1f}MB')
+    with open(args.output, 'w') as o_f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'results': results,
+        }, o_f, indent=2)
+    print(f'results written to {args.output}')
+
+
+def benchmark_compare(args):
+    """
+    Compares the seconds and peak RSS of the cases in both files. A case
+    regressed if it got slower or larger by more than the threshold.
+    """
+    with open(args.old, 'r') as i_f:
+        old = {r['name']: r for r in json.load(i_f)['results']}
+    with open(args.new, 'r') as i_f:
+        new = {r['name']: r for r in json.load(i_f)['results']}
+    regressions = 0
+    print(f'{"case":<36}{"old":>10}{"new":>10}{"time":>8}{"rss":>8}')
+    for name in sorted(old.keys() & new.keys()):
+        time_ratio = new[name]['seconds'] / old[name]['seconds']
+        rss_ratio = new[name]['peak_rss_mb'] / old[name]['peak_rss_mb']
+        regressed = time_ratio > 1 + args.threshold or rss_ratio > 1 + args.threshold
+        regressions += regressed
+        print(f'{name:<36}{old[name]["seconds"]:>9.3f}s{new[name]["seconds"]:>9.3f}s'
+              f'{time_ratio:>7.2f}x{rss_ratio:>7.2f}x{"  REGRESSION" if regressed else ""}')
+    for name in sorted(old.keys() ^ new.keys()):
+        print(f'{name:<36} only in {args.old if name in old else args.new}')
+    print(f'{regressions} regressions (threshold {args.threshold:.0%})')
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    suite = subparsers.add_parser('suite')
+    suite.add_argument('--output', default='benchmark.json')
+    suite.add_argument('--scale', type=float, default=1.0, help='factor for the number of documents and files')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--cases', default='', help='only run the cases whose name starts with this')
+    compare = subparsers.add_parser('compare')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1)
+    for name in ['nested', 'streaming', 'analytic', 'tokenizer']:
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument('--documents', type=int, default=10)
+        subparser.add_argument('--tokens', type=int, default=80000)
+        subparser.add_argument('--repeat', type=int, default=1)
+        subparser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args()
+    status = {
+        'suite': benchmark_suite,
+        'compare': benchmark_compare,
+        'nested': benchmark_nested,
+        'streaming': benchmark_streaming,
+        'analytic': benchmark_analytic,
+        'tokenizer': benchmark_tokenizer,
+    }[args.benchmark](args)
+    sys.exit(status or 0)
+
+
+if __name__ == '__main__':
+    main()
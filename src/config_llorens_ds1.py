@@ -1,10 +1,10 @@
 from dataloader import LlorensSingleLoader
+from evaluators import MemoryBudgetCvGridEvaluator
 from feature_extraction import LifeVectorizer
-from pipeline_tools import CustomCallbackTransformer, FileReader
+from pipeline_tools import FileReader, Tokenizer
 
 from dbispipeline import result_handlers
 from dbispipeline.base import MultiLoaderGenerator
-from dbispipeline.evaluators import CustomCvGridEvaluator
 
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.pipeline import Pipeline
@@ -13,7 +13,8 @@ dataloader = LlorensSingleLoader()
 
 pipeline = Pipeline([
     ('reader', FileReader()),
-    ('splitter', CustomCallbackTransformer(lambda x: x.split())),
+    # every task of the evaluator runs in a new process, the memo never hits
+    ('splitter', Tokenizer(memo_bytes=0)),
     ('life', LifeVectorizer(force=True)),
     ('rf', RandomForestClassifier(n_estimators=10, n_jobs=1)),
 ])
@@ -34,12 +35,9 @@ model_params = {
 
 grid_params ={
     'n_jobs': -1,
-    'verbose': 1,
-    'iid': False,
-    'return_train_score': False,
     'refit': False,
 }
 
-evaluator = CustomCvGridEvaluator(model_params, grid_params)
+evaluator = MemoryBudgetCvGridEvaluator(model_params, grid_params, corpus_dir=dataloader.basedir)
 
 result_handlers = []
@@ -1,10 +1,10 @@
 from ..dataloader import LlorensLoader
+from ..evaluators import MemoryBudgetCvGridEvaluator
 from ..feature_extraction import LifeVectorizer
-from ..pipeline_tools import CustomCallbackTransformer, FileReader
+from ..pipeline_tools import FileReader, Tokenizer
 
 from dbispipeline import result_handlers
 from dbispipeline.base import MultiLoaderGenerator
-from dbispipeline.evaluators import CustomCvGridEvaluator
 
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.pipeline import Pipeline
@@ -14,7 +14,8 @@ dataloader = LlorensLoader()
 
 pipeline = Pipeline([
     ('reader', FileReader()),
-    ('splitter', CustomCallbackTransformer(lambda x: x.split())),
+    # every task of the evaluator runs in a new process, the memo never hits
+    ('splitter', Tokenizer(memo_bytes=0)),
     ('life', LifeVectorizer(force=True)),
     ('rf', RandomForestClassifier(n_estimators=10, n_jobs=1)),
 ])
@@ -35,11 +36,8 @@ model_params = {
 
 grid_params ={
     'n_jobs': -1,
-    'verbose': 1,
-    'iid': False,
-    'return_train_score': False,
 }
 
-evaluator = CustomCvGridEvaluator(model_params, grid_params)
+evaluator = MemoryBudgetCvGridEvaluator(model_params, grid_params, corpus_dir=dataloader.basedir)
 
 result_handlers = []
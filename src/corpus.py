@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-tokenized binary corpora.
+
+A corpus is compiled once into a directory containing:
+    vocabulary.json  the tokens, their position is their id
+    tokens.bin       the token ids of all documents as one flat int32 array
+    offsets.npy      document i spans tokens[offsets[i]:offsets[i + 1]]
+    documents.json   the paths of the documents, in order
+
+The CompiledCorpusReader maps tokens.bin into memory and returns zero-copy
+slices of it, so worker processes share the same pages and no run has to
+decode or split the texts again.
+
+usage: python corpus.py llorens|bogdanova|reddit CORPUS_PATH OUTPUT_DIR
+"""
+import argparse
+from glob import glob
+import json
+import os
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from pipeline_tools import StatelessMixin, parse_chunk_id, stream
+
+
+def _read_text(path, field):
+    with open(path, 'r') as i_f:
+        content = i_f.read()
+    if field is not None:
+        content = json.loads(content)[field]
+    return content
+
+
+def compile_corpus(paths, output_dir, tokenizer=str.split, field=None):
+    """
+    Tokenizes the documents and writes them as a binary corpus.
+
+    :param paths: the documents, as returned by the loaders
+    :param output_dir: directory to write the corpus to
+    :param tokenizer: splits the content of a document into tokens
+    :param field: if set, the documents are JSON objects and only this field
+                  is tokenized
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    vocabulary = {}
+    offsets = [0]
+    with open(os.path.join(output_dir, 'tokens.bin'), 'wb') as o_f:
+        for path in paths:
+            tokens = tokenizer(_read_text(path, field))
+            ids = np.fromiter(
+                (vocabulary.setdefault(token, len(vocabulary)) for token in tokens),
+                dtype=np.int32,
+                count=len(tokens),
+            )
+            o_f.write(ids.tobytes())
+            offsets.append(offsets[-1] + len(ids))
+    np.save(os.path.join(output_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(output_dir, 'vocabulary.json'), 'w') as o_f:
+        json.dump(list(vocabulary), o_f)
+    with open(os.path.join(output_dir, 'documents.json'), 'w') as o_f:
+        json.dump([str(path) for path in paths], o_f)
+
+
+def compile_novels(loader, output_dir):
+    """
+    Compiles all documents of a NovelsLoader, split at whitespace. The
+    virtual chunks of a loader with a chunk_size are compiled as the novels
+    they come from.
+    """
+    data, _, _ = loader.load()
+    compile_corpus(list(dict.fromkeys(parse_chunk_id(document)[0] for document in data)), output_dir)
+
+
+def compile_reddit(corpus_path, output_dir):
+    """
+    Compiles the bodies of all posts of a reddit corpus. The reddit pipelines
+    pass the body to the LifeVectorizer without splitting it, so the tokens
+    are the characters.
+    """
+    paths = sorted(x for x in glob(f'{corpus_path}/*/*/*') if '.json' in x)
+    compile_corpus(paths, output_dir, tokenizer=list, field='body')
+
+
+class CompiledCorpus:
+
+    """Read-only view on a compiled corpus."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        with open(os.path.join(directory, 'documents.json'), 'r') as i_f:
+            self.documents = {path: i for i, path in enumerate(json.load(i_f))}
+        if self.offsets[-1] > 0:
+            self.tokens = np.memmap(os.path.join(directory, 'tokens.bin'), dtype=np.int32, mode='r')
+        else:
+            self.tokens = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getitem__(self, path):
+        i = self.documents[path]
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def vocabulary(self):
+        with open(os.path.join(self.directory, 'vocabulary.json'), 'r') as i_f:
+            return json.load(i_f)
+
+
+class CompiledCorpusReader(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    """
+    Transforms document paths into their token ids, read from a compiled
+    corpus. This replaces a FileReader and the tokenizing step of a pipeline.
+
+    input: list of paths, as used when compiling the corpus, or chunk ids of
+           them (see pipeline_tools.ChunkReader)
+    output: list of int32 arrays, which are views into the mapped corpus
+    """
+
+    def __init__(self, corpus_dir, lazy=False):
+        self.corpus_dir = corpus_dir
+        self.lazy = lazy
+
+    def __getstate__(self):
+        # every process maps the corpus itself
+        state = self.__dict__.copy()
+        state.pop('corpus_', None)
+        return state
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        if getattr(self, 'corpus_', None) is None:
+            self.corpus_ = CompiledCorpus(self.corpus_dir)
+        return stream((self._read(document) for document in X), self.lazy)
+
+    def _read(self, document):
+        path, start, stop = parse_chunk_id(document)
+        try:
+            tokens = self.corpus_[path]
+        except KeyError:
+            raise Exception('NO SUCH DOCUMENT IN COMPILED CORPUS: ', document)
+        if stop is not None and stop > len(tokens):
+            raise ValueError(f'{document} ends after the {len(tokens)} tokens of the compiled document')
+        return tokens[start:stop]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', choices=['llorens', 'bogdanova', 'reddit'])
+    parser.add_argument('corpus_path')
+    parser.add_argument('output_dir')
+    args = parser.parse_args()
+    if args.corpus == 'reddit':
+        compile_reddit(args.corpus_path, args.output_dir)
+    else:
+        from dataloader import BogdanovaLoader, LlorensLoader
+        loader = {'llorens': LlorensLoader, 'bogdanova': BogdanovaLoader}[args.corpus](args.corpus_path)
+        compile_novels(loader, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
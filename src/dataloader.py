@@ -9,6 +9,8 @@ import re
 from collections import defaultdict
 import numpy as np
 import logging
+from manifest import CorpusManifest
+from pipeline_tools import chunk_id
 logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
 
 DEFAULT_LLORENS_PATH = '../data/llorens'
@@ -17,6 +19,17 @@ DEFAULT_LLORENS_PATTERN = r'.*/(?P<author>\w+)/(?P<language>\w+)/(?P<title>.*).t
 DEFAULT_BOGDANOVA_PATH = '../data/bogdanova'
 DEFAULT_BOGDANOVA_PATTERN_CHUNKS = r'.*/(?P<author>\w+)/(?P<language>\w+)/chunks/\d\d_(?P<title>.*)_\d\d\d.txt'
 
+def virtual_chunks(path, n_tokens, chunk_size):
+    """
+    Returns the ids of the full chunks of chunk_size tokens of a document,
+    see pipeline_tools.ChunkReader. A document shorter than one chunk is a
+    single chunk.
+    """
+    if n_tokens < chunk_size:
+        return [chunk_id(path, 0, n_tokens)]
+    return [chunk_id(path, start, start + chunk_size) for start in range(0, n_tokens - chunk_size + 1, chunk_size)]
+
+
 class NovelsCrossValidator(BaseCrossValidator):
 
     def __init__(self, pattern, use_chunks, strict_languages=True, strict_titles=True):
@@ -25,82 +38,91 @@ class NovelsCrossValidator(BaseCrossValidator):
         self.strict_titles = strict_titles
         self.strict_languages = strict_languages
 
-    def get_n_splits(self, X, y, groups=None): 
-        return len(list(self.split(X, y)))
-
-    def split(self, X, y, groups=None):
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return len(self._get_splits(X))
+
+    def split(self, X, y=None, groups=None):
+        return self._get_splits(X)
+
+    def _get_splits(self, X):
+        """
+        The splits only depend on the file names, so they are computed once
+        and reused as long as the same files are passed again.
+        """
+        cached = getattr(self, '_splits', None)
+        if cached is not None:
+            files, splits = cached
+            if X is None or X is files or (len(X) == len(files) and all(a == b for a, b in zip(X, files))):
+                return splits
+        splits = self._compute_splits(X)
+        self._splits = (X, splits)
+        return splits
+
+    def metadata(self, X):
+        """
+        Parses the file names once into integer codes, one array each for
+        authors, languages, titles and works (title, author and language).
+        """
         files = [re.match(self.pattern, x) for x in X]
-        splits = []
-        if self.use_chunks: 
-            tested_titles = set()
-            for i, test_file in enumerate(files): 
-                test_title = test_file['title']
-                test_lang = test_file['language']
-                test_string = f'{test_title}_{test_file["author"]}_{test_lang}'
-                if test_string in tested_titles: 
-                    continue
-                tested_titles.add(test_string)
-                test_indices = [i]
-                train_indices = []
-                train_authors = set()
-
-                for j, other_file in enumerate(files): 
-                    other_lang = other_file['language']
-                    other_title = other_file['title']
-                    other_string = f'{other_title}_{other_file["author"]}_{other_lang}'
-
-                    if i == j:
-                        continue
-                    
-                    # a chunk of the same title can be used for testing 
-                    # simultaneously
-                    if other_string == test_string: 
-                        test_indices.append(j)
-                        continue 
-                    if self.strict_titles and test_file['title'] == other_file['title']:
-                        continue
-                    if self.strict_languages and test_file['language'] == other_file['language']:
-                        continue
-                    train_indices.append(j)
-                    train_authors.add(other_file['author'])
-
-                if test_file['author'] not in train_authors:
-                    continue
-                splits.append((train_indices, test_indices))
-            return splits
+        columns = {
+            'author': [f['author'] for f in files],
+            'language': [f['language'] for f in files],
+            'title': [f['title'] for f in files],
+            'work': [f'{f["title"]}_{f["author"]}_{f["language"]}' for f in files],
+        }
+        return {name: np.unique(values, return_inverse=True)[1].ravel() for name, values in columns.items()}
 
+    def _compute_splits(self, X):
+        meta = self.metadata(X)
+        authors, languages, titles = meta['author'], meta['language'], meta['title']
+        if self.use_chunks:
+            # all chunks of a work are tested together, the first chunk of a
+            # work represents it
+            works = meta['work']
+            _, representatives = np.unique(works, return_index=True)
+            candidates = np.sort(representatives)
         else:
-            for i, test_file in enumerate(files): 
-                test_indices = [i]
-                train_indices = []
-                train_authors = set()
-                for j, train_file in enumerate(files): 
-                    if i == j:
-                        continue
-                    if self.strict_titles and test_file['title'] == train_file['title']:
-                        continue
-                    if self.strict_languages and test_file['language'] == train_file['language']:
-                        continue
-                    train_indices.append(j)
-                    train_authors.add(train_file['author'])
-
-                if test_file['author'] not in train_authors:
-                    continue
-                splits.append((train_indices, test_indices))
-            return splits
+            works = np.arange(len(authors))
+            candidates = works
+
+        splits = []
+        for i in candidates:
+            test = works == works[i]
+            train = ~test
+            if self.strict_titles:
+                train &= titles != titles[i]
+            if self.strict_languages:
+                train &= languages != languages[i]
+            if not np.any(authors[train] == authors[i]):
+                continue
+            splits.append((np.flatnonzero(train), np.flatnonzero(test)))
+        return splits
 
 
 class NovelsLoader(Loader):  
 
-    def __init__(self, basedir, pattern, use_chunks=False, strict_titles=True, strict_languages=True):
+    def __init__(self, basedir, pattern, use_chunks=False, strict_titles=True, strict_languages=True, use_manifest=True, chunk_size=None):
         self.basedir = basedir
         self.pattern = pattern
         self.use_chunks = use_chunks
         self.strict_titles = strict_titles
         self.strict_languages = strict_languages
+        # use_manifest: list the corpus from a CorpusManifest instead of
+        # globbing, which only re-lists directories that changed
+        self.use_manifest = use_manifest
+        # chunk_size: split the full novels into virtual chunks of this many
+        # tokens instead of using pre-split chunk files. The documents are
+        # then chunk ids that have to be read with a ChunkReader, the pattern
+        # has to match the full novels.
+        self.chunk_size = chunk_size
 
     def load(self):
-        if self.use_chunks:
+        if self.chunk_size is not None:
+            all_textfiles = self._virtual_chunks()
+        elif self.use_manifest:
+            documents = CorpusManifest(self.basedir).documents('chunks' if self.use_chunks else None)
+            all_textfiles = [d['path'] for d in documents if d['path'].endswith('.txt')]
+        elif self.use_chunks:
             all_textfiles = glob(f'{self.basedir}/*/*/chunks/*.txt')
         else:
             all_textfiles = glob(f'{self.basedir}/*/*/*.txt')
@@ -113,9 +135,28 @@ class NovelsLoader(Loader):
         
         data = np.array([x.string for x in self.titles])
         labels = np.array([x['author'] for x in self.titles])
-        cv = NovelsCrossValidator(self.pattern, self.use_chunks, self.strict_languages, self.strict_titles)
+        # all chunks of a novel belong to the same work, like chunk files
+        use_chunks = self.use_chunks or self.chunk_size is not None
+        cv = NovelsCrossValidator(self.pattern, use_chunks, self.strict_languages, self.strict_titles)
         return data, labels, cv
 
+    def _virtual_chunks(self):
+        if not self.use_manifest:
+            ret = []
+            for path in glob(f'{self.basedir}/*/*/*.txt'):
+                with open(path, 'r') as i_f:
+                    ret += virtual_chunks(path, len(i_f.read().split()), self.chunk_size)
+            return ret
+        manifest = CorpusManifest(self.basedir)
+        ret = [
+            chunk
+            for d in list(manifest.documents())
+            if d['path'].endswith('.txt')
+            for chunk in virtual_chunks(d['path'], manifest.token_count(d), self.chunk_size)
+        ]
+        manifest.save()
+        return ret
+
     @property
     def configuration(self):
         return {
@@ -124,6 +165,7 @@ class NovelsLoader(Loader):
             'use_chunks': self.use_chunks,
             'strict_titles': self.strict_titles,
             'strict_languages': self.strict_languages,
+            'chunk_size': self.chunk_size,
         }
 
 
@@ -137,8 +179,15 @@ class LlorensLoader(NovelsLoader):
 class BogdanovaLoader(NovelsLoader): 
     def __init__(self, 
             path=DEFAULT_BOGDANOVA_PATH,
-            pattern=DEFAULT_BOGDANOVA_PATTERN_CHUNKS):
-        super().__init__(path, pattern, True, True, False)
+            pattern=None,
+            chunk_size=None):
+        """
+        :param chunk_size: use virtual chunks of the full novels instead of
+                           the files in the chunks directories
+        """
+        if pattern is None:
+            pattern = DEFAULT_BOGDANOVA_PATTERN_CHUNKS if chunk_size is None else DEFAULT_LLORENS_PATTERN
+        super().__init__(path, pattern, chunk_size is None, True, False, chunk_size=chunk_size)
 
 
 class LlorensSingleLoader(NovelsLoader): 
@@ -3,21 +3,76 @@
 from dbispipeline.base import TrainTestLoader, Loader
 from sklearn.preprocessing import LabelBinarizer
 import os
-from glob import glob
-
-def _get_all_categories(directory): 
-    return set([os.path.basename(x) for x in glob(f'{directory}/*/*')])
+import json
+from manifest import CorpusManifest
+from pipeline_tools import shard_path
+
+
+def pack_shards(directory, shard_dir):
+    """
+    Packs the posts of every author and category of a reddit corpus into one
+    JSON-lines file, <shard_dir>/<author>/<category>.jsonl, that can be read
+    by the JsonFieldReader instead of opening every post separately. A line
+    holds the file name, size and mtime (in ns) of a post and the post itself.
+    """
+    manifest = CorpusManifest(directory)
+    for author in manifest.subdirectories():
+        for category in manifest.subdirectories(author):
+            category_dir = os.path.join(directory, author, category)
+            path = shard_path(shard_dir, category_dir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'w') as o_f:
+                for name, is_dir, _, _ in manifest.listdir(os.path.join(author, category)):
+                    if is_dir or '.json' not in name:
+                        continue
+                    with open(os.path.join(category_dir, name), 'r') as i_f:
+                        stat = os.fstat(i_f.fileno())
+                        post = json.load(i_f)
+                    o_f.write(json.dumps({
+                        'name': name,
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime_ns,
+                        'post': post,
+                    }) + '\n')
+            os.replace(f'{path}.tmp', path)
+    manifest.save()
 
 
 def load_reddit_single(directory, category): 
     return load_reddit(directory, [category], [category])
 
+# the indexes of all corpora scanned by this process, see corpus_index
+_INDEXES = {}
+
+
+def corpus_index(directory):
+    """
+    Returns the posts of a reddit corpus as {author: {category: [paths]}},
+    with the paths sorted. The corpus is scanned once per process, all
+    loaders that point at the same directory share the index.
+    """
+    key = os.path.abspath(directory)
+    if key not in _INDEXES:
+        if not os.path.isdir(directory):
+            raise Exception('dataset not available: %s' % directory)
+        manifest = CorpusManifest(directory)
+        index = {}
+        for author in manifest.subdirectories():
+            index[author] = {}
+            for category in manifest.subdirectories(author):
+                files = manifest.listdir(os.path.join(author, category))
+                data = sorted(os.path.join(directory, author, category, name) for name, is_dir, _, _ in files if not is_dir)
+                index[author][category] = [x for x in data if '.json' in x]
+        manifest.save()
+        _INDEXES[key] = index
+    return _INDEXES[key]
+
+
 def load_reddit(directory, train_categories, test_categories):
-    if not os.path.isdir(directory):
-        raise Exception('dataset not available: %s' % directory)
     xtrain, ytrain, xtest, ytest = [], [], [], []
 
-    all_c = _get_all_categories(directory)
+    index = corpus_index(directory)
+    all_c = {category for categories in index.values() for category in categories}
     test_c = set(test_categories)
     train_c = set(train_categories)
 
@@ -27,26 +82,22 @@ def load_reddit(directory, train_categories, test_categories):
         raise Exception(f'requested training category ({train_c - all_c}) '
                 f'is not available from the categories {all_c}')
     if test_c - all_c:
-        raise Excgveption(f'requested testing category ({test_c - all_c}) is not available from the categories {all_c}.')
+        raise Exception(f'requested testing category ({test_c - all_c}) is not available from the categories {all_c}.')
     if len(test_c & train_c) == 1 and len(train_c) > 1:
         raise Exception(f'using multiple categories with one of them overlapping for training and testing ({test_c & train_c}) is not supported')
     if len(test_c & train_c) > 1:
         raise Exception(f'using more than one overlapping category for training and testing ({test_c & train_c}) is not supported')
 
 
-    for i, author in enumerate(sorted(os.listdir(directory))):
-        author_dir = os.path.join(directory, author)
-        if not os.path.isdir(author_dir):
-            continue
+    for i, author in enumerate(sorted(index)):
+        categories = index[author]
 
         for category in all_c:
-            category_dir = os.path.join(author_dir, category)
-            if not os.path.isdir(category_dir): 
+            if category not in categories:
                 continue
             if category not in train_c and category not in test_c:
                 continue
-            data = sorted(glob(f'{category_dir}/*'))
-            data = [x for x in data if '.json' in x]
+            data = list(categories[category])
             labels = [author] * len(data)
 
             if single_category or category in train_c:
@@ -65,18 +116,32 @@ def load_reddit(directory, train_categories, test_categories):
 class RedditLoader(TrainTestLoader): 
 
     def __init__(self, corpus_path, train_categories, test_categories, load_classes_one_hot=False):
-        data = load_reddit(corpus_path, train_categories, test_categories)
-        xtrain, ytrain, xtest, ytest, train_categories, test_categories = data
-        if load_classes_one_hot:
-            lb = LabelBinarizer()
-            lb.fit(ytrain)
-            ytrain = lb.transform(ytrain)
-            ytest = lb.transform(ytest)
-        self.train = (xtrain, ytrain)
+        # the corpus is only scanned when the data is requested for the first time
         self.corpus_path = corpus_path
-        self.test = (xtest, ytest)
         self.train_categories = train_categories
         self.test_categories = test_categories
+        self.load_classes_one_hot = load_classes_one_hot
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            data = load_reddit(self.corpus_path, self.train_categories, self.test_categories)
+            xtrain, ytrain, xtest, ytest, _, _ = data
+            if self.load_classes_one_hot:
+                lb = LabelBinarizer()
+                lb.fit(ytrain)
+                ytrain = lb.transform(ytrain)
+                ytest = lb.transform(ytest)
+            self._data = (xtrain, ytrain), (xtest, ytest)
+        return self._data
+
+    @property
+    def train(self):
+        return self._load()[0]
+
+    @property
+    def test(self):
+        return self._load()[1]
 
     def load_train(self):
         """Returns the train data."""
@@ -108,9 +173,11 @@ class RedditSingleCategoryLoader(Loader):
 
     def __init__(self, corpus_path, category):
         self.corpus_path = corpus_path
-        self.data, self.labels, self.category = load_reddit_single(corpus_path, category)
+        self.category = category
+
     def load(self): 
-        return self.data, self.labels
+        data, labels, _ = load_reddit_single(self.corpus_path, self.category)
+        return data, labels
 
     @property
     def configuration(self):
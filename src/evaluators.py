@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluators that avoid recomputing features shared by grid candidates, and
+that keep the memory of parallel grid searches within a budget.
+"""
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+from dbispipeline.evaluators import CustomCvGridEvaluator
+from scipy.stats import rankdata
+from sklearn.base import clone
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid
+from sklearn.pipeline import Pipeline
+
+from feature_extraction import LifeVectorizer
+from feature_store import stable_repr
+from manifest import CorpusManifest
+from memory import LOG_PATH, MemoryModel, current_rss, document_sizes, peak_rss, physical_memory, raw_estimate, token_representation
+
+# the grid parameters MemoryBudgetCvGridEvaluator takes into account, cv is
+# replaced by the one of the loader as with every CustomCvGridEvaluator
+_SUPPORTED_GRID_PARAMS = {'n_jobs', 'scoring', 'error_score', 'refit', 'cv'}
+# LifeVectorizer parameters that do not change the feature values
+_IGNORED_PARAMS = {'fragment_sizes', 'n_jobs', 'cache', 'matrices'}
+
+
+def is_stateless(estimator):
+    """Whether fit learns nothing, see pipeline_tools.StatelessMixin."""
+    try:
+        from sklearn.utils import get_tags
+    except ImportError:
+        # scikit-learn < 1.6
+        return estimator._get_tags().get('stateless', False)
+    return not get_tags(estimator).requires_fit
+
+
+def _group_key(vectorizer):
+    """Identifies the vectorizers that only differ in their fragment sizes."""
+    params = vectorizer.get_params(deep=False)
+    return repr(sorted((name, stable_repr(value)) for name, value in params.items() if name not in _IGNORED_PARAMS))
+
+
+def grid_outcome(candidates, scores, fit_times, score_times, skip_missing=False):
+    """
+    Returns the outcome a GridEvaluator without refit returns for the scores
+    and times of shape (candidates, folds). Like in GridSearchCV, a candidate
+    with a NaN score in any fold gets a NaN mean and is ranked last, unless
+    skip_missing is set, which leaves such folds out of the means (e.g., of
+    the partial results of scheduler.collect). Folds without a time are
+    always left out of the mean times.
+    """
+    cv_results = {
+        'mean_fit_time': np.nanmean(fit_times, axis=1),
+        'std_fit_time': np.nanstd(fit_times, axis=1),
+        'mean_score_time': np.nanmean(score_times, axis=1),
+        'std_score_time': np.nanstd(score_times, axis=1),
+    }
+    for name in sorted({name for params in candidates for name in params}):
+        cv_results[f'param_{name}'] = [params.get(name) for params in candidates]
+    cv_results['params'] = candidates
+    for fold in range(scores.shape[1]):
+        cv_results[f'split{fold}_test_score'] = scores[:, fold]
+    mean, std = (np.nanmean, np.nanstd) if skip_missing else (np.mean, np.std)
+    means = mean(scores, axis=1)
+    cv_results['mean_test_score'] = means
+    cv_results['std_test_score'] = std(scores, axis=1)
+    cv_results['rank_test_score'] = rankdata(-np.nan_to_num(means, nan=-np.inf), method='min').astype(np.int32)
+
+    best = int(np.nanargmax(means)) if not np.all(np.isnan(means)) else None
+    return {
+        'cv_results': pd.DataFrame(cv_results).to_dict(),
+        'best_score': float(means[best]) if best is not None else None,
+        'best_params': candidates[best] if best is not None else None,
+    }
+
+
+class FeatureMatrices(dict):
+
+    """
+    Precomputed feature matrices by group key, together with the fragment
+    sizes of their blocks. They are shared and not copied when a
+    PrecomputedLifeFeatures step is cloned.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PrecomputedLifeFeatures(LifeVectorizer):
+
+    """
+    Replaces the steps up to the LifeVectorizer of a pipeline by a lookup in
+    precomputed feature matrices. It takes the parameters of a
+    LifeVectorizer, so that the grid parameters of the 'life' step still
+    apply, and returns the columns of the requested fragment sizes.
+
+    input: row indices into the matrices, i.e., of the documents
+    output: array of shape (len(X), n_features())
+    """
+
+    def __init__(self, fragment_sizes=[200, 500, 800, 1000, 1500, 2000, 3000, 4000], samples=200, sample_type='bow', force=True, sliding_window=False, nested=False, cache=None, random_state=None, n_jobs=None, dtype=np.float64, tolerance=None, sample_batch=20, analytic=False, matrices=None):
+        super().__init__(fragment_sizes, samples, sample_type, force, sliding_window, nested, cache, random_state, n_jobs, dtype, tolerance, sample_batch, analytic)
+        self.matrices = matrices
+
+    def transform(self, X, y=None):
+        sizes, matrix = self.matrices[_group_key(self)]
+        width = 8 * len(self.methods())
+        columns = np.concatenate([
+            np.arange(sizes.index(size) * width, (sizes.index(size) + 1) * width)
+            for size in self.fragment_sizes
+        ])
+        return matrix[np.ix_(np.asarray(X, dtype=np.intp).ravel(), columns)]
+
+
+class PrefixSharingCvGridEvaluator(CustomCvGridEvaluator):
+
+    """
+    A CustomCvGridEvaluator that computes the features of the LifeVectorizer
+    step once instead of for every grid candidate and fold.
+
+    This works if the steps up to and including the LifeVectorizer are
+    stateless and the grid only varies parameters of the LifeVectorizer and
+    of the steps after it. The blocks of different fragment sizes are
+    independent, so one matrix is computed for the union of all fragment
+    size lists of a group of candidates that agree in all other LifeVectorizer
+    parameters (e.g., sample_type), and every candidate fits the remaining
+    steps on its columns. Otherwise, or with nested=True, where the blocks
+    depend on the other sizes, the grid is evaluated as usual.
+
+    The cv object is resolved to explicit splits with the documents, since
+    the grid search itself only sees row indices. If the grid refits, the
+    best parameters are refit on the original pipeline.
+    """
+
+    def __init__(self, params, grid_params, step='life'):
+        super().__init__(params, grid_params)
+        self.step = step
+
+    def shared_prefix(self, model):
+        """Returns the index of the step whose features can be shared, or None."""
+        names = [name for name, _ in model.steps]
+        if self.step not in names:
+            return None
+        index = names.index(self.step)
+        if not isinstance(model.steps[index][1], LifeVectorizer):
+            return None
+        if not all(is_stateless(estimator) for _, estimator in model.steps[:index + 1]):
+            return None
+        grids = self.parameters if isinstance(self.parameters, list) else [self.parameters]
+        for grid in grids:
+            for name in grid:
+                if name.split('__')[0] in names[:index]:
+                    return None
+        return index
+
+    def evaluate(self, model, data):
+        index = self.shared_prefix(model)
+        candidates = list(ParameterGrid(self.parameters))
+        vectorizers = [
+            clone(model.steps[index][1]).set_params(**{
+                name[len(self.step) + 2:]: value
+                for name, value in candidate.items()
+                if name.startswith(f'{self.step}__')
+            })
+            for candidate in candidates
+        ] if index is not None else []
+        if index is None or any(vectorizer.nested for vectorizer in vectorizers):
+            logging.info('the features cannot be shared between the grid candidates')
+            return super().evaluate(model, data)
+
+        x, y, cv = data
+        # the union of the fragment sizes of every group, in order
+        groups = {}
+        for vectorizer in vectorizers:
+            sizes = groups.setdefault(_group_key(vectorizer), (vectorizer, []))[1]
+            sizes += [size for size in vectorizer.fragment_sizes if size not in sizes]
+
+        matrices = FeatureMatrices()
+        for key, (vectorizer, sizes) in groups.items():
+            logging.info(f'computing the features of {len(x)} documents for the fragment sizes {sizes}')
+            prefix = Pipeline(
+                [(name, clone(estimator)) for name, estimator in model.steps[:index]]
+                + [(self.step, clone(vectorizer).set_params(fragment_sizes=sizes))]
+            )
+            matrices[key] = (sizes, prefix.fit_transform(x))
+
+        params = model.steps[index][1].get_params(deep=False)
+        shared = Pipeline(
+            [(self.step, PrecomputedLifeFeatures(**params, matrices=matrices))]
+            + [(name, clone(estimator)) for name, estimator in model.steps[index + 1:]]
+        )
+        splits = list(cv.split(x, y))
+        refit = self.grid_parameters.get('refit', True)
+        self.grid_parameters['refit'] = False
+        try:
+            result = super().evaluate(shared, (np.arange(len(x)), y, splits))
+        finally:
+            self.grid_parameters['refit'] = refit
+        if refit and result['best_params'] is not None:
+            self.model_ = clone(model).set_params(**result['best_params']).fit(x, y)
+        return result
+
+    @property
+    def configuration(self):
+        configuration = super().configuration
+        configuration['step'] = self.step
+        return configuration
+
+
+def _fit_and_score(estimator, x, y, train, test, scoring, connection):
+    """Runs in a forked worker, sends the scores and the memory it allocated."""
+    baseline = current_rss()
+    try:
+        start = time.perf_counter()
+        estimator.fit(x[train], y[train])
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        score = check_scoring(estimator, scoring=scoring)(estimator, x[test], y[test])
+        result = {'test_score': float(score), 'fit_time': fit_time, 'score_time': time.perf_counter() - start}
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    result['peak'] = max(peak_rss() - baseline, 0)
+    connection.send(result)
+    connection.close()
+
+
+class MemoryBudgetCvGridEvaluator(CustomCvGridEvaluator):
+
+    """
+    A CustomCvGridEvaluator that runs every (grid candidate, fold) in a
+    forked worker, but only starts a worker while the estimated peak
+    memories of the running ones fit into a budget.
+
+    The estimates come from the sizes of the documents (taken from the
+    corpus manifest, or stat'ed) and the LifeVectorizer parameters of the
+    candidate, see memory.py. The tasks are started largest first, and a
+    task that does not fit lets smaller ones that do fit go ahead. A task
+    estimated larger than the whole budget runs alone. The peak of every
+    task is measured and logged to log_path, which refines the estimates of
+    later tasks and runs.
+
+    Every task runs in a new process, so nothing a process keeps between
+    transforms is reused across candidates and folds, e.g., the memo of a
+    Tokenizer, which is best disabled with memo_bytes=0.
+
+    A worker that is killed (e.g., by the OOM killer) counts as a failed fit
+    and gets the error_score of the grid parameters, their number is given
+    as failed_tasks in the outcome. Only a single scoring is supported, and
+    a warning is logged for the grid parameters besides n_jobs, scoring,
+    error_score and refit, which are ignored.
+    """
+
+    def __init__(self, params, grid_params, memory_budget=None, corpus_dir=None, log_path=LOG_PATH):
+        """
+        :param memory_budget: bytes the workers may allocate together,
+                              defaults to 80% of the physical memory less
+                              what this process uses
+        :param corpus_dir: root of the corpus, its manifest provides the
+                           document sizes
+        :param log_path: where the measured peaks are logged, None to not
+                         learn from them
+        """
+        super().__init__(params, grid_params)
+        for name in grid_params:
+            if name not in _SUPPORTED_GRID_PARAMS:
+                logging.warning(f'{type(self).__name__} ignores the grid parameter {name}={grid_params[name]!r}')
+        self.memory_budget = memory_budget
+        self.corpus_dir = corpus_dir
+        self.log_path = log_path
+
+    def estimates(self, model, candidates, x, folds):
+        """Returns the raw peak estimates of every candidate and fold."""
+        manifest = CorpusManifest(self.corpus_dir) if self.corpus_dir is not None else None
+        sizes, tokens = document_sizes(x, manifest)
+        ret = np.zeros((len(candidates), len(folds)))
+        for i, params in enumerate(candidates):
+            estimator = clone(model).set_params(**params)
+            representation = token_representation(estimator)
+            vectorizer = next((step for _, step in estimator.steps if isinstance(step, LifeVectorizer)), None)
+            for j, (train, test) in enumerate(folds):
+                ret[i, j] = max(
+                    raw_estimate(sizes[train], tokens[train], representation, vectorizer),
+                    raw_estimate(sizes[test], tokens[test], representation, vectorizer),
+                )
+        return ret
+
+    def evaluate(self, model, data):
+        x, y, cv = data
+        x, y = np.asarray(x), np.asarray(y)
+        folds = list(cv.split(x, y))
+        candidates = list(ParameterGrid(self.parameters))
+        scoring = self.grid_parameters.get('scoring')
+        if not (scoring is None or isinstance(scoring, str) or callable(scoring)):
+            raise ValueError('only a single scoring is supported')
+        error_score = self.grid_parameters.get('error_score', np.nan)
+        n_jobs = self.grid_parameters.get('n_jobs') or 1
+        if n_jobs < 0:
+            n_jobs = max(os.cpu_count() + 1 + n_jobs, 1)
+        budget = self.memory_budget
+        if budget is None:
+            budget = 0.8 * physical_memory() - current_rss()
+
+        memory = MemoryModel(self.log_path)
+        raw = self.estimates(model, candidates, x, folds)
+        pending = sorted(np.ndindex(raw.shape), key=lambda task: -raw[task])
+        logging.info(
+            f'running {len(pending)} tasks on up to {n_jobs} workers within {budget / 2 ** 20:.0f}MB, '
+            f'the largest estimated at {memory.estimate(raw.max()) / 2 ** 20:.0f}MB')
+
+        scores = np.full(raw.shape, np.nan)
+        fit_times = np.full(raw.shape, np.nan)
+        score_times = np.full(raw.shape, np.nan)
+        context = multiprocessing.get_context('fork')
+        # connection: (process, task, estimate)
+        running = {}
+        try:
+            while pending or running:
+                used = sum(estimate for _, _, estimate in running.values())
+                while pending and len(running) < n_jobs:
+                    task = next((task for task in pending if used + memory.estimate(raw[task]) <= budget), None)
+                    if task is None and running:
+                        break
+                    if task is None:
+                        task = pending[0]
+                        logging.warning(
+                            f'task {task} is estimated at {memory.estimate(raw[task]) / 2 ** 20:.0f}MB, '
+                            f'more than the budget, running it alone')
+                    pending.remove(task)
+                    candidate, fold = task
+                    train, test = folds[fold]
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(
+                        target=_fit_and_score,
+                        args=(clone(model).set_params(**candidates[candidate]), x, y, train, test, scoring, sender),
+                        daemon=True,
+                    )
+                    process.start()
+                    sender.close()
+                    running[receiver] = (process, task, memory.estimate(raw[task]))
+                    used += running[receiver][2]
+                    logging.debug(f'started task {task}, {len(running)} running with {used / 2 ** 20:.0f}MB')
+
+                for receiver in wait(list(running)):
+                    process, task, estimate = running.pop(receiver)
+                    try:
+                        result = receiver.recv()
+                    except EOFError:
+                        result = None
+                    receiver.close()
+                    process.join()
+                    candidate, fold = task
+                    if result is None:
+                        result = {'error': f'the worker died with exit code {process.exitcode}'}
+                    else:
+                        memory.add({
+                            'n_train': len(folds[fold][0]),
+                            'n_test': len(folds[fold][1]),
+                            'params': stable_repr(candidates[candidate]),
+                            'raw_estimate': raw[task],
+                            'estimate': estimate,
+                            'peak': result['peak'],
+                        })
+                    if 'error' in result:
+                        if error_score == 'raise':
+                            raise RuntimeError(f'fitting {candidates[candidate]} on fold {fold} failed:\n{result["error"]}')
+                        logging.warning(f'fitting {candidates[candidate]} on fold {fold} failed: {result["error"]}')
+                        scores[task] = error_score
+                        continue
+                    scores[task] = result['test_score']
+                    fit_times[task] = result['fit_time']
+                    score_times[task] = result['score_time']
+        finally:
+            for process, _, _ in running.values():
+                process.terminate()
+
+        outcome = grid_outcome(candidates, scores, fit_times, score_times)
+        outcome['failed_tasks'] = int(np.isnan(fit_times).sum())
+        if self.grid_parameters.get('refit', True) and outcome['best_params'] is not None:
+            self.model_ = clone(model).set_params(**outcome['best_params']).fit(x, y)
+        return outcome
+
+    @property
+    def configuration(self):
+        configuration = super().configuration
+        configuration['memory_budget'] = self.memory_budget
+        return configuration
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for feature blocks, shared between processes.
+
+The blocks are stored in a SQLite database, which takes care of locking when
+several worker processes of a grid search read and write at the same time.
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+
+def content_hash(*parts):
+    """Returns a hex digest identifying the given strings, numbers or arrays."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(part.dtype.str.encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class SQLiteDatabase:
+
+    """
+    A SQLite database that can be pickled and copied (e.g., by sklearn's
+    clone or by joblib), each process opens its own connection. SCHEMA holds
+    the statements that create the tables.
+    """
+
+    SCHEMA = []
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: the SQLite file, it is created if it does not exist
+        :param timeout: seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction, it holds the write lock of the database."""
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+class FeatureCache(SQLiteDatabase):
+
+    """
+    Content-addressed store of numpy arrays with a size bound.
+
+    When the database grows larger than max_bytes, the least recently used
+    entries are evicted.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, value BLOB, dtype TEXT, last_used REAL)',
+        'CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used)',
+    ]
+    # seconds within which the last use of an entry is not updated again
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_bytes=1024 ** 3, timeout=60):
+        """
+        :param path: the SQLite file, it is created if it does not exist
+        :param max_bytes: the size the cache is trimmed to, in bytes
+        :param timeout: seconds to wait for a lock held by another process
+        """
+        super().__init__(path, timeout)
+        self.max_bytes = max_bytes
+
+    def get(self, keys):
+        """
+        Returns a dict of the keys that are cached and their arrays. The
+        lookup runs in a read transaction, which does not block other
+        readers or a writer. The last use of an entry is only written if it
+        is older than TOUCH_INTERVAL, so that mostly reads do not wait for
+        the write lock.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ','.join('?' * len(keys))
+        rows = self.connection.execute(
+            f'SELECT key, value, dtype, last_used FROM blocks WHERE key IN ({placeholders})', keys).fetchall()
+        now = time.time()
+        stale = [(now, key) for key, _, _, last_used in rows if now - last_used > self.TOUCH_INTERVAL]
+        if stale:
+            with self.transaction() as connection:
+                connection.executemany('UPDATE blocks SET last_used = ? WHERE key = ?', stale)
+        return {key: np.frombuffer(value, dtype=dtype) for key, value, dtype, _ in rows}
+
+    def put(self, blocks):
+        """Stores a dict of keys and arrays and evicts old entries if needed."""
+        if not blocks:
+            return
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)',
+                [(key, np.ascontiguousarray(value).tobytes(), value.dtype.str, now) for key, value in blocks.items()])
+        self.evict()
+
+    def size(self):
+        """Returns the number of bytes used by entries, including overhead."""
+        connection = self.connection
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        free = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - free) * page_size
+
+    def evict(self):
+        """Deletes the least recently used entries until the size bound holds."""
+        used = self.size()
+        if used <= self.max_bytes:
+            return
+        with self.transaction() as connection:
+            entries = connection.execute('SELECT COUNT(*) FROM blocks').fetchone()[0]
+            # remove an extra tenth, so that not every put has to evict again
+            remove = int(entries * (1 - self.max_bytes / used)) + entries // 10 + 1
+            connection.execute(
+                'DELETE FROM blocks WHERE key IN '
+                '(SELECT key FROM blocks ORDER BY last_used LIMIT ?)', (remove,))
+
+    def clear(self):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM blocks')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM blocks').fetchone()[0]
+
+    def __repr__(self):
+        return f'FeatureCache({self.path!r}, max_bytes={self.max_bytes})'
@@ -4,13 +4,297 @@
 
 from sklearn.base import BaseEstimator
 from sklearn.base import TransformerMixin
-from collections import defaultdict
+from sklearn.utils import check_random_state
+from joblib import Parallel, delayed, effective_n_jobs
+from joblib.parallel import get_active_backend
+from scipy.special import gammaln
+import itertools
+import numbers
 import numpy as np
+import os
 import random
+import tempfile
 
-class LifeVectorizer(BaseEstimator, TransformerMixin):
+from feature_cache import content_hash
+from pipeline_tools import StatelessMixin
 
-    def __init__(self, fragment_sizes=[200, 500, 800, 1000, 1500, 2000, 3000, 4000], samples=200, sample_type='bow', force=True):
+SAMPLE_METHODS = ['bow', 'fragment']
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# number of documents per worker that a parallel transform reads from its
+# input at once, which bounds the memory used for a lazily streamed corpus
+PARALLEL_BATCH_SIZE = 64
+# the occurrence counts of the features v1, v2 and v3. v0 is computed from
+# the number of types that do not occur, i.e., the band (0, 0).
+FREQUENCY_BANDS = [(0, 0), (1, 1), (2, 4), (5, 10)]
+
+
+def token_ids(words):
+    """
+    Maps the tokens of a document to dense integer ids, in order of their
+    first occurrence. This is the only place where the tokens are hashed, all
+    sampling and counting is done on the returned id array.
+
+    Documents that are already integer arrays (e.g., from a
+    CompiledCorpusReader) are relabeled the same way, so that a document gets
+    the same ids, and hence the same random streams, either way. Arrays that
+    are numbered this way already (e.g., from a Tokenizer) are taken as they
+    are.
+    """
+    if isinstance(words, np.ndarray) and words.dtype.kind in 'iu':
+        # every id is at most one larger than all ids before it
+        if not len(words) or (words[0] == 0 and np.all(words[1:] <= np.maximum.accumulate(words[:-1]) + 1)):
+            return words.astype(np.int32, copy=False)
+        _, first, inverse = np.unique(words, return_index=True, return_inverse=True)
+        relabel = np.empty(len(first), dtype=np.int32)
+        relabel[np.argsort(first)] = np.arange(len(first), dtype=np.int32)
+        return relabel[inverse.ravel()]
+    vocabulary = {}
+    return np.fromiter(
+        (vocabulary.setdefault(word, len(vocabulary)) for word in words),
+        dtype=np.int32,
+        count=len(words),
+    )
+
+
+class Document:
+
+    """
+    A document converted once at transform time, shared by all sample
+    methods and fragment sizes: the dense int32 token ids and the number of
+    types. The frequency of every type, the frequency spectrum and the
+    content hash are computed when they are first needed.
+    """
+
+    __slots__ = ['ids', 'n_types', '_frequencies', '_spectrum', '_hash']
+
+    def __init__(self, ids):
+        """:param ids: dense token ids, as returned by token_ids"""
+        self.ids = ids
+        self.n_types = int(ids.max()) + 1 if len(ids) else 0
+        self._frequencies = None
+        self._spectrum = None
+        self._hash = None
+
+    @classmethod
+    def from_tokens(cls, words):
+        """Converts a list of tokens (or an integer array) into a Document."""
+        return cls(token_ids(words))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def frequencies(self):
+        """The number of occurrences of every type."""
+        if self._frequencies is None:
+            self._frequencies = np.bincount(self.ids, minlength=self.n_types)
+        return self._frequencies
+
+    @property
+    def spectrum(self):
+        """The distinct frequencies and the number of types having them."""
+        if self._spectrum is None:
+            self._spectrum = np.unique(self.frequencies, return_counts=True)
+        return self._spectrum
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = content_hash(self.ids)
+        return self._hash
+
+    def whole_features(self):
+        """The LIFE features of the whole document."""
+        return _bucket_counts(self.frequencies)
+
+
+def count_features(ids, indices):
+    """
+    Computes the LIFE features [v0, v1, v2, v3] for each sample at once.
+
+    :param ids: token ids of the document
+    :param indices: 2-D array, each row contains the token positions of one
+                    sample
+    :return: integer array of shape (len(indices), 4)
+    """
+    tokens = np.sort(ids[indices], axis=1)
+    n_samples, width = tokens.shape
+    starts = np.ones(tokens.shape, dtype=bool)
+    starts[:, 1:] = tokens[:, 1:] != tokens[:, :-1]
+    # every row starts a new run, so runs never span two samples
+    positions = np.flatnonzero(starts)
+    lengths = np.diff(np.append(positions, tokens.size))
+    rows = positions // max(width, 1)
+
+    features = np.empty((n_samples, 4), dtype=np.int64)
+    features[:, 0] = np.bincount(rows, minlength=n_samples)
+    features[:, 1] = np.bincount(rows[lengths == 1], minlength=n_samples)
+    features[:, 2] = np.bincount(rows[(lengths >= 2) & (lengths <= 4)], minlength=n_samples)
+    features[:, 3] = np.bincount(rows[(lengths >= 5) & (lengths <= 10)], minlength=n_samples)
+    return features
+
+
+def _bucket_counts(counts):
+    return np.array([
+        np.count_nonzero(counts),
+        np.count_nonzero(counts == 1),
+        np.count_nonzero((counts >= 2) & (counts <= 4)),
+        np.count_nonzero((counts >= 5) & (counts <= 10)),
+    ])
+
+
+def update_counts(counts, added, dropped):
+    """
+    Updates a token frequency table in place and returns by how much the
+    features [v0, v1, v2, v3] changed. Only the tokens that are added or
+    dropped are touched.
+    """
+    touched = np.unique(np.concatenate([added, dropped]))
+    before = _bucket_counts(counts[touched])
+    np.add.at(counts, added, 1)
+    np.subtract.at(counts, dropped, 1)
+    return _bucket_counts(counts[touched]) - before
+
+
+def prefix_features(ids, indices, sizes):
+    """
+    Computes the LIFE features of the prefixes of all samples at once.
+
+    A token is in the bucket [a, b] of a prefix of length s if its a-th
+    occurrence lies before s and its (b+1)-th does not. Counting the
+    occurrences that enter and leave a bucket between two consecutive sizes
+    and summing them up yields the features of every prefix length after a
+    single sort of the samples.
+
+    :param indices: 2-D array, each row contains the token positions of one
+                    sample
+    :param sizes: ascending prefix lengths, at most indices.shape[1]
+    :return: integer array of shape (len(sizes), len(indices), 4)
+    """
+    n_samples, width = indices.shape
+    # sorting by token and position at once keeps the occurrences of a token
+    # in the order they appear in the sample
+    keys = np.sort(ids[indices].astype(np.int64) * width + np.arange(width), axis=1)
+    tokens, positions = np.divmod(keys, width)
+    starts = np.ones(tokens.shape, dtype=bool)
+    starts[:, 1:] = tokens[:, 1:] != tokens[:, :-1]
+    flat = np.arange(tokens.size)
+    run_start = np.maximum.accumulate(np.where(starts.ravel(), flat, 0))
+    rank = (flat - run_start).reshape(tokens.shape)
+    # an occurrence at position p is part of all prefixes from the first size
+    # larger than p on
+    n_bins = len(sizes) + 1
+    bins = np.arange(n_samples)[:, np.newaxis] * n_bins + np.searchsorted(sizes, positions, side='right')
+
+    def occurrences(k):
+        counts = np.bincount(bins[rank == k], minlength=n_samples * n_bins)
+        return np.cumsum(counts.reshape(n_samples, n_bins), axis=1)[:, :-1]
+
+    first, second, fifth, eleventh = [occurrences(k) for k in [0, 1, 4, 10]]
+    features = np.stack([first, first - second, second - fifth, fifth - eleventh], axis=2)
+    return features.transpose(1, 0, 2).astype(np.int64)
+
+
+def sliding_features(ids, lefts, fragment_size, n_types=None):
+    """
+    Computes the LIFE features of the fragments starting at the given offsets
+    by sliding one window over the document in order of the offsets. Each
+    step only counts the tokens that enter and leave the window.
+
+    :param n_types: the largest token id plus one, computed if not given
+    :return: integer array of shape (len(lefts), 4), in the order of lefts
+    """
+    if n_types is None:
+        n_types = int(ids.max()) + 1 if len(ids) else 0
+    counts = np.zeros(n_types, dtype=np.int32)
+    current = np.zeros(4, dtype=np.int64)
+    features = np.empty((len(lefts), 4), dtype=np.int64)
+    previous = None
+    for i in np.argsort(lefts, kind='stable'):
+        left = lefts[i]
+        if previous is None:
+            added, dropped = ids[left:left + fragment_size], ids[:0]
+        else:
+            dropped = ids[previous:min(left, previous + fragment_size)]
+            added = ids[max(left, previous + fragment_size):left + fragment_size]
+        current += update_counts(counts, added, dropped)
+        features[i] = current
+        previous = left
+    return features
+
+
+def bow_statistics(document, sizes):
+    """
+    Computes the means and mean/std ratios of the LIFE features of 'bow'
+    samples exactly, i.e., as if infinitely many samples were drawn.
+
+    A type occurring f times in a document of N tokens occurs k times in a
+    sample of n tokens without replacement with the hypergeometric
+    probability C(f, k) H(f, k), where H(s, t) = C(N - s, n - t) / C(N, n).
+    Two types occurring f and g times occur k and j times with probability
+    C(f, k) C(g, j) H(f + g, k + j). The expected features follow from the
+    first, their variances from the second, summed over all pairs of types.
+    The types are grouped by their frequency and the pairs by f + g, so the
+    cost depends on the number of distinct frequencies and not on the
+    number or size of samples.
+
+    :param document: a Document
+    :param sizes: the fragment sizes, at most len(document)
+    :return: float array of shape (len(sizes), 8), like _summarize
+    """
+    n_tokens = len(document)
+    frequencies, n_types = document.spectrum
+    # log(k!) for all integers up to the document size
+    log_factorials = gammaln(np.arange(n_tokens + 1) + 1)
+
+    def log_binomial(a, b):
+        a, b = np.broadcast_arrays(a, b)
+        valid = (b >= 0) & (b <= a)
+        ret = np.full(a.shape, -np.inf)
+        ret[valid] = log_factorials[a[valid]] - log_factorials[b[valid]] - log_factorials[a[valid] - b[valid]]
+        return ret
+
+    sizes = np.asarray(sizes, dtype=np.int64)[:, np.newaxis]
+
+    def h(s, t):
+        """H(s, t) for every fragment size, shape (len(sizes), len(s))."""
+        return np.exp(log_binomial(n_tokens - s, sizes - t) - log_binomial(n_tokens, sizes))
+
+    # the frequency classes of all pairs of types, grouped by f + g
+    sums, pairs = np.unique(frequencies[:, np.newaxis] + frequencies, return_inverse=True)
+    pairs = pairs.reshape(len(frequencies), len(frequencies))
+    weights = {k: n_types * np.exp(log_binomial(frequencies, k)) for k in range(FREQUENCY_BANDS[-1][1] + 1)}
+
+    means = np.empty((len(sizes), 4))
+    variances = np.empty((len(sizes), 4))
+    for band, (low, high) in enumerate(FREQUENCY_BANDS):
+        mean = sum(h(frequencies, k) @ weights[k] for k in range(low, high + 1))
+        # expected number of ordered pairs of distinct types that are both
+        # in the band
+        pair_sum = 0
+        for k in range(low, high + 1):
+            for j in range(k, high + 1):
+                by_sum = np.bincount(pairs.ravel(), np.outer(weights[k], weights[j]).ravel(), minlength=len(sums))
+                # pairs of a type with itself
+                by_sum[np.diag(pairs)] -= weights[k] * np.exp(log_binomial(frequencies, j))
+                pair_sum = pair_sum + (1 if j == k else 2) * (h(sums, k + j) @ by_sum)
+        means[:, band] = mean
+        variances[:, band] = mean + pair_sum - mean ** 2
+    means[:, 0] = n_types.sum() - means[:, 0]
+
+    # variances that vanish up to rounding, e.g., when the sample is the
+    # whole document
+    second_moments = variances + means ** 2
+    stds = np.sqrt(np.where(variances > 1e-9 * np.maximum(second_moments, 1), variances, 0))
+    return np.concatenate([
+        means,
+        np.divide(means, stds, out=np.zeros_like(means), where=stds != 0)
+    ], axis=1)
+
+
+class LifeVectorizer(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    def __init__(self, fragment_sizes=[200, 500, 800, 1000, 1500, 2000, 3000, 4000], samples=200, sample_type='bow', force=True, sliding_window=False, nested=False, cache=None, random_state=None, n_jobs=None, dtype=np.float64, tolerance=None, sample_batch=20, analytic=False):
         valid_sample_types = ['bow', 'fragment', 'both']
         if sample_type not in valid_sample_types:
             raise ValueError(f'unknown sample type: {sample_type}. valid values: {valid_sample_types}')
@@ -18,71 +302,328 @@ class LifeVectorizer(BaseEstimator, TransformerMixin):
         self.samples = samples
         self.sample_type = sample_type
         self.force = force
+        # sliding_window: count 'fragment' samples by sliding one window over
+        # the sorted offsets instead of counting every window from scratch.
+        # The features are the same, only the cost differs.
+        self.sliding_window = sliding_window
+        # nested: draw the samples once for the largest fragment size and use
+        # their prefixes for the smaller sizes, see get_nested_features.
+        self.nested = nested
+        # cache: a FeatureCache that stores the block of every (document,
+        # fragment size, sample method) combination, so that grid candidates
+        # and folds sharing a document and a size compute it only once. As
+        # long as the sampling is not seeded, the cache keeps the first draw.
+        self.cache = cache
+        # random_state: None samples with the global random module. An int
+        # (or a RandomState, which is drawn from once per transform call)
+        # seeds an independent stream per document, fragment size and sample
+        # method, derived from the document content. The features are then
+        # the same no matter how the documents are batched or distributed
+        # over processes.
+        self.random_state = random_state
+        # n_jobs: number of processes transform distributes the documents to.
+        # Inside the workers of an outer joblib loop (e.g., a grid search with
+        # n_jobs=-1) the documents are always processed sequentially.
+        self.n_jobs = n_jobs
+        # dtype: of the returned feature matrix, e.g., np.float32 to halve the
+        # memory of the matrix and of the forest trained on it. The features
+        # are always computed in float64.
+        self.dtype = dtype
+        # tolerance: if set, the samples are drawn in batches of sample_batch
+        # until the standard error of every mean/std feature is below the
+        # tolerance, see converged. The ratios range from about 2 to 40, a
+        # tolerance of 1 to 3 is reasonable. samples is the upper bound then.
+        # The numbers drawn are stored in samples_drawn_.
+        self.tolerance = tolerance
+        self.sample_batch = sample_batch
+        # analytic: compute the 'bow' features exactly from the frequency
+        # spectrum of the document instead of sampling, see bow_statistics.
+        # No samples are drawn for them then.
+        self.analytic = analytic
 
     def fit(self, X, y=None):
         return self
 
-    def sample(self, words, fragment_size, method):
-        ret = []
-        wordcount = len(words)
-        if wordcount < fragment_size: 
-            if self.force:
-                return [words] * self.samples
-            else:
-                raise ValueError(f'fragment size ({fragment_size}) is larger than document size ({wordcount}) for document starting with: \n\n{document[:250]}\n\n')
-        for i in range(self.samples): 
-            if method == 'fragment': 
-                left = random.randint(0, wordcount - fragment_size)
-                right = left + fragment_size
-                ret.append(words[left:right])
-            if method == 'bow': 
-                ret.append(random.sample(words, fragment_size))
+    def sample_offsets(self, wordcount, fragment_size, rng=None, n_samples=None):
+        """Draws the start offsets of all 'fragment' samples of one size."""
+        n_samples = self.samples if n_samples is None else n_samples
+        if rng is not None:
+            return rng.integers(0, wordcount - fragment_size + 1, size=n_samples)
+        return np.array([random.randint(0, wordcount - fragment_size) for _ in range(n_samples)])
+
+    def sample_indices(self, wordcount, fragment_size, method, rng=None, n_samples=None):
+        """
+        Draws the token positions of all samples of one fragment size.
+        Without a random generator, the draws are the same as picking the
+        samples from the word list directly with the random module, i.e.,
+        random.randint per 'fragment' and random.sample per 'bow' sample.
+
+        :return: array of shape (n_samples, fragment_size), n_samples
+                 defaults to samples
+        """
+        n_samples = self.samples if n_samples is None else n_samples
+        if method == 'fragment':
+            lefts = self.sample_offsets(wordcount, fragment_size, rng, n_samples)
+            return lefts[:, np.newaxis] + np.arange(fragment_size)
+        if rng is not None:
+            return np.array([rng.choice(wordcount, fragment_size, replace=False) for _ in range(n_samples)])
+        population = range(wordcount)
+        return np.array([random.sample(population, fragment_size) for _ in range(n_samples)], dtype=np.intp)
+
+    def random_seed(self):
+        """
+        Resolves random_state to the seed of one transform call: None for the
+        global random module, otherwise an integer.
+        """
+        if self.random_state is None or isinstance(self.random_state, numbers.Integral):
+            return self.random_state
+        return int(check_random_state(self.random_state).randint(np.iinfo(np.int32).max))
+
+    @staticmethod
+    def random_generator(seed, document, fragment_size, method):
+        """
+        Returns the random stream of one document, fragment size and sample
+        method, or None if the sampling is not seeded. The stream only
+        depends on the seed and the document content, so the features of a
+        document do not depend on the other documents of a transform call.
+        """
+        if seed is None:
+            return None
+        return np.random.default_rng([seed, int(document, 16), fragment_size, SAMPLE_METHODS.index(method)])
+
+    def methods(self):
+        return ['bow', 'fragment'] if self.sample_type == 'both' else [self.sample_type]
+
+    def document_features(self, document, seed=None):
+        """
+        Returns the feature blocks of one Document, one per fragment size,
+        and the number of samples drawn per fragment size and method.
+        """
+        if self.nested:
+            if self.tolerance is not None:
+                raise ValueError('adaptive sampling (tolerance) is not supported with nested=True')
+            return self.get_nested_features(document, seed)
+
+        methods = self.methods()
+        document_hash = document.hash if seed is not None or self.cache is not None else None
+        keys = {
+            (size, method): content_hash(document_hash, size, method, self.samples, self.force, seed, self.tolerance, self.sample_batch, self.analytic)
+            for size in self.fragment_sizes for method in methods
+        }
+        # a block holds the 8 features followed by the number of samples
+        blocks = {} if self.cache is None else self.cache.get(keys.values())
+        missing = {}
+        if self.analytic:
+            sizes = [size for (size, method), key in keys.items() if method == 'bow' and key not in blocks and size <= len(document)]
+            for size, features in zip(sizes, bow_statistics(document, sizes) if sizes else []):
+                blocks[keys[size, 'bow']] = missing[keys[size, 'bow']] = np.append(features, 0)
+        for (size, method), key in keys.items():
+            if key not in blocks:
+                rng = self.random_generator(seed, document_hash, size, method)
+                features, drawn = self._get_features(document, size, method, rng)
+                blocks[key] = missing[key] = np.append(features, drawn)
+        if self.cache is not None:
+            self.cache.put(missing)
+        features = [
+            np.concatenate([blocks[keys[size, method]][:-1] for method in methods])
+            for size in self.fragment_sizes
+        ]
+        drawn = [blocks[keys[size, method]][-1] for size in self.fragment_sizes for method in methods]
+        return features, drawn
+
+    def get_nested_features(self, document, seed=None):
+        """
+        Computes the features of all fragment sizes in one pass. Each sample
+        is drawn once for the largest size, and the sample of a smaller size
+        is a prefix of it. The counts are accumulated from the smallest to the
+        largest size in one pass over the sample, see prefix_features.
+
+        Statistical behaviour: for 'bow', the prefix of a sample without
+        replacement is itself a uniform sample, so each size on its own has
+        the same distribution as with independent draws. For 'fragment', all
+        sizes start at an offset drawn for the largest size, so the last
+        tokens of a document are covered less by the smaller fragments. In
+        both cases the estimates of different sizes share tokens and are
+        therefore correlated, which independent sampling avoids. When seeded,
+        the random stream of the largest size is used.
+        """
+        nested = {method: self._get_nested_features(document, method, seed) for method in self.methods()}
+        features = [
+            np.concatenate([nested[method][size][0] for method in self.methods()])
+            for size in self.fragment_sizes
+        ]
+        drawn = [nested[method][size][1] for size in self.fragment_sizes for method in self.methods()]
+        return features, drawn
+
+    def _get_nested_features(self, document, method, seed):
+        sizes = sorted(set(self.fragment_sizes))
+        drawn = [size for size in sizes if size <= len(document)]
+        ret = {size: self._get_features(document, size, method) for size in sizes if size > len(document)}
+        if not drawn:
+            return ret
+        if method == 'bow' and self.analytic:
+            ret.update((size, (features, 0)) for size, features in zip(drawn, bow_statistics(document, drawn)))
+            return ret
+
+        rng = self.random_generator(seed, document.hash if seed is not None else None, drawn[-1], method)
+        indices = self.sample_indices(len(document), drawn[-1], method, rng)
+        for size, features in zip(drawn, prefix_features(document.ids, indices, drawn)):
+            ret[size] = self._summarize(np.ascontiguousarray(features)), self.samples
         return ret
 
-    def get_features_for_sample(self, sample):
-        counts = defaultdict(int)
-        for word in sample: 
-            counts[word] += 1
-        v0 = len(counts.keys())
-        v1, v2, v3 = 0, 0, 0
-        for word, occurrances in counts.items():
-            if occurrances <= 1:
-                v1 += 1
-            elif occurrances <= 4:
-                v2 += 1
-            elif occurrances <= 10:
-                v3 += 1
-        
-        return [v0, v1, v2, v3]
-
-
-    def get_features(self, document, sample_size): 
-        if self.sample_type == 'both': 
-            return np.concatenate([
-                self._get_features(document, sample_size, 'bow'),
-                self._get_features(document, sample_size, 'fragment'),
-            ])
-        else:
-            return self._get_features(document, sample_size, self.sample_type)
+    def _get_features(self, document, fragment_size, method, rng=None):
+        """Returns the summarized features and the number of samples drawn."""
+        if len(document) < fragment_size:
+            if not self.force:
+                raise ValueError(f'fragment size ({fragment_size}) is larger than document size ({len(document)})')
+            # every sample is the whole document
+            return self._summarize(np.repeat([document.whole_features()], self.samples, axis=0)), 1
+        if self.tolerance is None:
+            return self._summarize(self._draw_features(document, fragment_size, method, rng, self.samples)), self.samples
+
+        batches = []
+        drawn = 0
+        while drawn < self.samples:
+            n_samples = min(self.sample_batch, self.samples - drawn)
+            batches.append(self._draw_features(document, fragment_size, method, rng, n_samples))
+            drawn += n_samples
+            features = np.concatenate(batches)
+            if self.converged(features):
+                break
+        return self._summarize(features), drawn
 
+    def _draw_features(self, document, fragment_size, method, rng, n_samples):
+        if method == 'fragment' and self.sliding_window:
+            lefts = self.sample_offsets(len(document), fragment_size, rng, n_samples)
+            return sliding_features(document.ids, lefts, fragment_size, document.n_types)
+        return count_features(document.ids, self.sample_indices(len(document), fragment_size, method, rng, n_samples))
 
-    def _get_features(self, document, fragment_size, method):
-        samples = self.sample(document, fragment_size, method)
-        features = []
-        for sample in samples:
-            features.append(self.get_features_for_sample(sample))
-        features = np.array(features)
+    def converged(self, features):
+        """
+        Whether the standard errors of all mean/std ratios of the samples are
+        below the tolerance. The standard error of a ratio r = mean / std is
+        about sqrt((1 + r^2 / 2) / n) for normally distributed counts. It is
+        compared in absolute terms: relative to r it would approach
+        1 / sqrt(2n) for every document and size, so the number of samples
+        would not depend on the data. Larger fragments have larger ratios,
+        since their counts vary less relative to their mean, and need more
+        samples. A feature with std 0 has an exact ratio of 0.
+        """
+        n = len(features)
+        if n < 2:
+            return False
+        means = np.mean(features, axis=0)
+        stds = np.std(features, axis=0)
+        ratios = np.divide(means, stds, out=np.zeros_like(means), where=stds!=0)
+        errors = np.sqrt((1 + ratios ** 2 / 2) / n)
+        errors[stds == 0] = 0
+        return bool(np.all(errors <= self.tolerance))
+
+    def _summarize(self, features):
         means = np.mean(features, axis=0)
         stds = np.std(features, axis=0)
         return np.concatenate([
-            means, 
+            means,
             np.divide(means, stds, out=np.zeros_like(means), where=stds!=0)
         ])
 
+    def effective_n_jobs(self):
+        backend, _ = get_active_backend()
+        if getattr(backend, 'nesting_level', 0):
+            # the outer parallel loop already occupies the cores
+            return 1
+        return effective_n_jobs(self.n_jobs)
+
+    def n_features(self):
+        """Number of columns of the feature matrix."""
+        return len(self.fragment_sizes) * len(self.methods()) * 8
 
     def transform(self, X, y=None):
-        ret = []
-        for document in X:
-            doc = [self.get_features(document, size) for size in self.fragment_sizes]
-            ret.append(np.concatenate(doc))
+        """
+        X can be any iterable of documents, including a generator of a lazy
+        pipeline step. Only the fixed-size feature vectors are kept for every
+        document, plus one batch of token ids when running in parallel.
+
+        :return: array of shape (len(X), n_features()). The rows are written
+                 in place, if X has no length the array grows as needed.
+                 samples_drawn_ holds the number of samples drawn per
+                 document, fragment size and method, in the order of the
+                 feature blocks.
+        """
+        seed = self.random_seed()
+        n_jobs = self.effective_n_jobs()
+        ret = np.empty((len(X) if hasattr(X, '__len__') else 0, self.n_features()), dtype=self.dtype)
+        self.samples_drawn_ = np.empty((len(ret), len(self.fragment_sizes) * len(self.methods())), dtype=np.int64)
+        n_documents = 0
+        if n_jobs == 1:
+            for document in X:
+                ret = _reserve(ret, n_documents + 1)
+                self.samples_drawn_ = _reserve(self.samples_drawn_, n_documents + 1)
+                features, self.samples_drawn_[n_documents] = self.document_features(Document.from_tokens(document), seed)
+                np.concatenate(features, out=ret[n_documents])
+                n_documents += 1
+        else:
+            documents = iter(X)
+            while True:
+                batch = [Document.from_tokens(document) for document in itertools.islice(documents, PARALLEL_BATCH_SIZE * n_jobs)]
+                if not batch:
+                    break
+                ret = _reserve(ret, n_documents + len(batch))
+                self.samples_drawn_ = _reserve(self.samples_drawn_, n_documents + len(batch))
+                rows = slice(n_documents, n_documents + len(batch))
+                self._parallel_transform(batch, seed, n_jobs, ret[rows], self.samples_drawn_[rows])
+                n_documents += len(batch)
+        if len(ret) != n_documents:
+            ret.resize((n_documents, ret.shape[1]), refcheck=False)
+            self.samples_drawn_.resize((n_documents, self.samples_drawn_.shape[1]), refcheck=False)
         return ret
+
+    def _parallel_transform(self, documents, seed, n_jobs, out, drawn):
+        """
+        Computes the features on a process pool. The token ids of all
+        documents are written to one file in shared memory that the workers
+        map instead of receiving pickled copies. The documents are split into
+        contiguous chunks of about the same number of tokens, several per
+        worker to even out the load. The features are written to out, the
+        numbers of samples to drawn.
+        """
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        np.cumsum([len(document) for document in documents], out=offsets[1:])
+        if offsets[-1] == 0 or len(documents) < 2:
+            for i, document in enumerate(documents):
+                features, drawn[i] = self.document_features(document, seed)
+                np.concatenate(features, out=out[i])
+            return
+
+        n_chunks = min(len(documents), 4 * n_jobs)
+        targets = np.linspace(0, offsets[-1], n_chunks + 1)[1:-1]
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(offsets, targets), [len(documents)]]))
+
+        with tempfile.TemporaryDirectory(dir=SHARED_MEMORY_DIR) as directory:
+            path = os.path.join(directory, 'tokens.bin')
+            np.concatenate([document.ids for document in documents]).astype(np.int32).tofile(path)
+            del documents
+            chunks = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(_transform_chunk)(self, path, offsets[start:stop + 1], seed)
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            )
+        for start, stop, (features, samples) in zip(bounds[:-1], bounds[1:], chunks):
+            out[start:stop] = features
+            drawn[start:stop] = samples
+
+
+def _reserve(features, n_documents):
+    """Grows a feature matrix in place to hold at least n_documents rows."""
+    if len(features) < n_documents:
+        features.resize((max(n_documents, 2 * len(features)), features.shape[1]), refcheck=False)
+    return features
+
+
+def _transform_chunk(vectorizer, path, offsets, seed):
+    tokens = np.memmap(path, dtype=np.int32, mode='r')
+    ret = np.empty((len(offsets) - 1, vectorizer.n_features()), dtype=vectorizer.dtype)
+    drawn = np.empty((len(ret), len(vectorizer.fragment_sizes) * len(vectorizer.methods())), dtype=np.int64)
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        features, drawn[i] = vectorizer.document_features(Document(np.asarray(tokens[start:stop])), seed)
+        np.concatenate(features, out=ret[i])
+    return ret, drawn
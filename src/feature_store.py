@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent per-document features for corpora that keep growing.
+
+Unlike the FeatureCache, which is a bounded cache of feature blocks, the
+FeatureStore keeps the final feature vector of every document path for every
+parameter fingerprint it was computed with, until it is garbage collected.
+The IncrementalFeatures transformer uses it to compute only the documents
+that are new or changed since the last run.
+"""
+import hashlib
+import os
+import time
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from feature_cache import SQLiteDatabase, content_hash
+from pipeline_tools import parse_chunk_id
+
+# parameters that change how features are computed, but not their values
+IGNORED_PARAMS = {'n_jobs', 'n_threads', 'batch_size', 'lazy', 'cache', 'memo_bytes'}
+
+
+def file_hash(path):
+    """Returns a hex digest of the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as i_f:
+        for block in iter(lambda: i_f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _code_hash(code):
+    # the repr of nested code objects contains their address
+    return content_hash(
+        code.co_code,
+        code.co_names,
+        tuple(_code_hash(c) if hasattr(c, 'co_code') else c for c in code.co_consts),
+    )
+
+
+def stable_repr(value):
+    """A representation of a parameter value that does not change between runs."""
+    if isinstance(value, BaseEstimator):
+        # the parameters of nested estimators are listed separately
+        return type(value).__qualname__
+    if isinstance(value, (list, tuple)):
+        return [stable_repr(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((k, stable_repr(v)) for k, v in value.items())
+    if isinstance(value, np.ndarray):
+        return content_hash(value)
+    if isinstance(value, np.random.RandomState):
+        return content_hash(*value.get_state())
+    if hasattr(value, '__code__'):
+        return f'{value.__module__}.{value.__qualname__}:{_code_hash(value.__code__)}'
+    if callable(value) and not isinstance(value, type):
+        return f'{type(value).__module__}.{type(value).__qualname__}'
+    return repr(value)
+
+
+def fingerprint(transformer):
+    """
+    Returns a hex digest of the class and all (nested) parameters of a
+    transformer, e.g., fragment_sizes, samples, sample_type, force and
+    random_state of a LifeVectorizer. Functions are identified by their code.
+    """
+    params = transformer.get_params(deep=True)
+    return content_hash(type(transformer).__qualname__, sorted(
+        (name, stable_repr(value))
+        for name, value in params.items()
+        if name.split('__')[-1] not in IGNORED_PARAMS
+    ))
+
+
+class FeatureStore(SQLiteDatabase):
+
+    """
+    Feature vectors by document path and parameter fingerprint, together
+    with the size, mtime and content hash of the document they were computed
+    from.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS features '
+        '(path TEXT, fingerprint TEXT, size INTEGER, mtime INTEGER, hash TEXT, '
+        'value BLOB, dtype TEXT, updated REAL, PRIMARY KEY (path, fingerprint))',
+    ]
+
+    def get(self, paths, fingerprint):
+        """Returns {path: (size, mtime, hash, vector)} of the stored paths."""
+        ret = {}
+        connection = self.connection
+        paths = list(paths)
+        # stay below SQLite's limit of variables per statement
+        for start in range(0, len(paths), 500):
+            batch = paths[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = connection.execute(
+                f'SELECT path, size, mtime, hash, value, dtype FROM features '
+                f'WHERE fingerprint = ? AND path IN ({placeholders})', [fingerprint] + batch)
+            for path, size, mtime, digest, value, dtype in rows:
+                ret[path] = (size, mtime, digest, np.frombuffer(value, dtype=dtype))
+        return ret
+
+    def put(self, fingerprint, entries):
+        """Stores a dict of {path: (size, mtime, hash, vector)}."""
+        if not entries:
+            return
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (path, fingerprint, size, mtime, digest, np.ascontiguousarray(vector).tobytes(), vector.dtype.str, now)
+                    for path, (size, mtime, digest, vector) in entries.items()
+                ])
+
+    def touch(self, fingerprint, entries):
+        """Updates the size and mtime of documents whose content did not change."""
+        if not entries:
+            return
+        with self.transaction() as connection:
+            connection.executemany(
+                'UPDATE features SET size = ?, mtime = ? WHERE path = ? AND fingerprint = ?',
+                [(size, mtime, path, fingerprint) for path, (size, mtime) in entries.items()])
+
+    def gc(self, fingerprints=None):
+        """
+        Deletes the entries of documents that do not exist anymore and, if
+        fingerprints is given, all entries computed with other parameters.
+
+        :return: the number of deleted entries
+        """
+        connection = self.connection
+        stale = [
+            (path, fp) for path, fp in connection.execute('SELECT path, fingerprint FROM features')
+            if not os.path.isfile(path) or (fingerprints is not None and fp not in fingerprints)
+        ]
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM features WHERE path = ? AND fingerprint = ?', stale)
+        return len(stale)
+
+    def compact(self):
+        """Gives the space of deleted entries back to the file system."""
+        self.connection.execute('VACUUM')
+
+    def fingerprints(self):
+        """Returns {fingerprint: number of entries}."""
+        return dict(self.connection.execute('SELECT fingerprint, COUNT(*) FROM features GROUP BY fingerprint'))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def __repr__(self):
+        return f'FeatureStore({self.path!r})'
+
+
+class IncrementalFeatures(BaseEstimator, TransformerMixin):
+
+    """
+    Computes the features of document paths with a transformer, e.g., a
+    Pipeline of FileReader, splitter and LifeVectorizer, but only for the
+    documents that are not in the store yet or that changed since. All other
+    vectors are read from the store.
+
+    A document counts as unchanged if its size and mtime are the same, or
+    else if its content hash is the same. The transformer must not learn
+    anything in fit, and the features of a document must not depend on the
+    other documents. For a LifeVectorizer, this means that random_state has
+    to be an int, otherwise the features of a document depend on the
+    documents transformed before it.
+
+    input: list of paths or chunk ids, which are compared by their file
+    output: array of shape (len(X), n_features)
+    """
+
+    def __init__(self, transformer, store):
+        self.transformer = transformer
+        self.store = store
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        paths = [str(path) for path in X]
+        key = fingerprint(self.transformer)
+        stored = self.store.get(set(paths), key)
+
+        vectors = {}
+        touched = {}
+        missing = {}
+        # the files of chunk ids (see pipeline_tools.ChunkReader) are only
+        # stat'ed and hashed once for all of their chunks
+        stats = {}
+        digests = {}
+        for path in set(paths):
+            source = parse_chunk_id(path)[0]
+            if source not in stats:
+                stats[source] = os.stat(source)
+            stat = stats[source]
+            entry = stored.get(path)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                vectors[path] = entry[3]
+                continue
+            if source not in digests:
+                digests[source] = file_hash(source)
+            digest = digests[source]
+            if entry is not None and entry[2] == digest:
+                vectors[path] = entry[3]
+                touched[path] = (stat.st_size, stat.st_mtime_ns)
+            else:
+                missing[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        self.store.touch(key, touched)
+
+        if missing:
+            computed = np.asarray(self.transformer.fit_transform(list(missing)))
+            self.store.put(key, {
+                path: entry + (vector,)
+                for (path, entry), vector in zip(missing.items(), computed)
+            })
+            vectors.update(zip(missing, computed))
+        # the number of recomputed documents of the last call
+        self.n_computed_ = len(missing)
+        if not paths:
+            return np.zeros((0, 0))
+        return np.vstack([vectors[path] for path in paths])
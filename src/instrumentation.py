@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing of the steps of a pipeline.
+
+instrument() returns a copy of a pipeline whose steps (and the pipeline
+itself) are replaced by subclasses that record every fit, transform and
+predict call: wall time, CPU time, number of documents and peak memory. The
+subclasses take the same parameters, so grid searches work unchanged.
+
+Every process appends its records to its own file in the log directory,
+which makes it work for the worker processes of a grid search with
+n_jobs=-1. report() merges the files afterwards. The ProfilingEvaluator does
+both around another evaluator and adds the report to its result, next to the
+scores.
+
+Steps that return generators (lazy=True) only do their work when the next
+step consumes them, so their time is counted for the consuming step.
+"""
+import glob
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+from dbispipeline.base import Evaluator
+
+from feature_cache import content_hash
+from feature_store import fingerprint
+from memory import peak_rss
+
+METHODS = ['fit', 'transform', 'fit_transform', 'predict', 'predict_proba', 'score']
+PIPELINE_STEP = '<pipeline>'
+
+# the grid candidate and the fold the pipeline of this process is working
+# on, and the id of the fitted pipeline (several folds can share the same
+# training documents)
+_CONTEXT = {'candidate': None, 'fold': None, 'run': None}
+# estimators with a call in progress, the calls they make to themselves
+# (e.g., fit_transform calling fit and transform) are not recorded again
+_ACTIVE = set()
+_CLASSES = {}
+
+
+def _peak_rss_mb():
+    return peak_rss() / 2 ** 20
+
+
+def _fold_id(X):
+    """Identifies a fold by the documents it was trained on."""
+    return content_hash(np.array([str(x) for x in X]))[:8]
+
+
+def _profiled_method(name):
+    def method(self, X, *args, **kwargs):
+        original = getattr(self._profiled_base, name)
+        if id(self) in _ACTIVE:
+            return original(self, X, *args, **kwargs)
+
+        pipeline = self._profiled_step == PIPELINE_STEP
+        if pipeline:
+            if name in ['fit', 'fit_transform']:
+                self.profiled_candidate_ = fingerprint(self)[:8]
+                self.profiled_fold_ = _fold_id(X)
+                self.profiled_run_ = uuid.uuid4().hex[:8]
+            for key in _CONTEXT:
+                _CONTEXT[key] = getattr(self, f'profiled_{key}_', None)
+        trace = self._profiled_trace_memory and not pipeline
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+        _ACTIVE.add(id(self))
+        rss = _peak_rss_mb()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return original(self, X, *args, **kwargs)
+        finally:
+            _ACTIVE.discard(id(self))
+            record = {
+                'step': self._profiled_step,
+                'class': self._profiled_base.__name__,
+                'method': name,
+                'candidate': _CONTEXT['candidate'],
+                'fold': _CONTEXT['fold'],
+                'run': _CONTEXT['run'],
+                'pid': os.getpid(),
+                'wall': time.perf_counter() - wall,
+                'cpu': time.process_time() - cpu,
+                'documents': len(X) if hasattr(X, '__len__') else None,
+                'peak_rss_mb': _peak_rss_mb(),
+                'rss_growth_mb': _peak_rss_mb() - rss,
+            }
+            if trace:
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            os.makedirs(self._profiled_log_dir, exist_ok=True)
+            with open(os.path.join(self._profiled_log_dir, f'profile-{os.getpid()}.jsonl'), 'a') as o_f:
+                o_f.write(json.dumps(record) + '\n')
+    method.__name__ = name
+    return method
+
+
+def _restore(base, step, log_dir, trace_memory):
+    cls = profiled_class(base, step, log_dir, trace_memory)
+    return cls.__new__(cls)
+
+
+def profiled_class(base, step, log_dir, trace_memory=False):
+    """
+    Returns the subclass of an estimator class that records its calls as
+    the given step. The classes are created once per process, instances are
+    pickled as the base class plus the profiling settings.
+    """
+    key = (base, step, log_dir, trace_memory)
+    if key not in _CLASSES:
+        namespace = {
+            name: _profiled_method(name) for name in METHODS if hasattr(base, name)
+        }
+        namespace.update({
+            '_profiled_base': base,
+            '_profiled_step': step,
+            '_profiled_log_dir': log_dir,
+            '_profiled_trace_memory': trace_memory,
+            '__module__': __name__,
+            '__reduce__': lambda self: (_restore, key, self.__getstate__()),
+        })
+        _CLASSES[key] = type(f'Profiled{base.__name__}', (base,), namespace)
+    return _CLASSES[key]
+
+
+def instrument(pipeline, log_dir, trace_memory=False):
+    """
+    Returns a copy of the pipeline that records its calls to log_dir.
+
+    :param trace_memory: additionally record the peak of the memory
+                         allocated by Python during each step call, using
+                         tracemalloc. This slows down the steps a lot. The
+                         peak RSS of the process is always recorded.
+    """
+    steps = [
+        (name, profiled_class(type(step), name, log_dir, trace_memory)(**step.get_params(deep=False)))
+        for name, step in pipeline.steps
+    ]
+    params = pipeline.get_params(deep=False)
+    params['steps'] = steps
+    return profiled_class(type(pipeline), PIPELINE_STEP, log_dir, trace_memory)(**params)
+
+
+def read_records(log_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(log_dir, 'profile-*.jsonl'))):
+        with open(path, 'r') as i_f:
+            records += [json.loads(line) for line in i_f if line.strip()]
+    return records
+
+
+def report(log_dir):
+    """
+    Merges the records of all processes into a JSON-serializable dict:
+        steps: totals per step and method, in the order of their first call
+        folds: totals of the pipeline calls per fitted pipeline, i.e., per
+               grid candidate and fold
+        processes: the number of processes that recorded calls
+    """
+    records = read_records(log_dir)
+    steps = {}
+    folds = {}
+    for record in records:
+        key = (record['step'], record['method'])
+        entry = steps.setdefault(key, {
+            'step': record['step'],
+            'class': record['class'],
+            'method': record['method'],
+            'calls': 0,
+            'wall': 0.0,
+            'cpu': 0.0,
+            'documents': 0,
+            'peak_rss_mb': 0.0,
+        })
+        entry['calls'] += 1
+        entry['wall'] += record['wall']
+        entry['cpu'] += record['cpu']
+        entry['documents'] += record['documents'] or 0
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], record['peak_rss_mb'])
+        if 'traced_peak_mb' in record:
+            entry['traced_peak_mb'] = max(entry.get('traced_peak_mb', 0.0), record['traced_peak_mb'])
+
+        if record['step'] == PIPELINE_STEP:
+            fold = folds.setdefault(record['run'], {
+                'candidate': record['candidate'],
+                'fold': record['fold'],
+                'wall': 0.0,
+                'cpu': 0.0,
+            })
+            fold['wall'] += record['wall']
+            fold['cpu'] += record['cpu']
+            fold[f'{record["method"]}_documents'] = record['documents']
+
+    for entry in steps.values():
+        entry['documents_per_second'] = entry['documents'] / entry['wall'] if entry['wall'] else None
+    return {
+        'steps': list(steps.values()),
+        'folds': list(folds.values()),
+        'processes': len({record['pid'] for record in records}),
+    }
+
+
+def format_report(profile):
+    """Returns the step totals of a report as a table."""
+    lines = [f'{"step":<16}{"method":<16}{"calls":>7}{"wall":>11}{"cpu":>11}{"docs/s":>11}{"peak rss":>11}']
+    for entry in profile['steps']:
+        rate = entry['documents_per_second']
+        lines.append(
+            f'{entry["step"]:<16}{entry["method"]:<16}{entry["calls"]:>7}{entry["wall"]:>10.2f}s'
+            f'{entry["cpu"]:>10.2f}s{rate if rate is not None else float("nan"):>11.1f}{entry["peak_rss_mb"]:>9.1f}MB')
+    return '\n'.join(lines)
+
+
+class ProfilingEvaluator(Evaluator):
+
+    """
+    Evaluates an instrumented copy of the model with another evaluator and
+    adds the report to its result as 'profile', so that the result handlers
+    store it with the scores.
+    """
+
+    def __init__(self, evaluator, log_dir=None, trace_memory=False):
+        """
+        :param evaluator: the evaluator to wrap, e.g., a CustomCvGridEvaluator
+        :param log_dir: where the processes write their records, a new
+                        temporary directory per evaluation by default. Old
+                        records in it are deleted.
+        :param trace_memory: see instrument
+        """
+        self.evaluator = evaluator
+        self.log_dir = log_dir
+        self.trace_memory = trace_memory
+
+    def __getattr__(self, name):
+        # e.g., fitted_model or model_ of the wrapped evaluator
+        if name == 'evaluator':
+            raise AttributeError(name)
+        return getattr(self.evaluator, name)
+
+    def evaluate(self, model, data):
+        log_dir = self.log_dir or tempfile.mkdtemp(prefix='profile-')
+        for path in glob.glob(os.path.join(log_dir, 'profile-*.jsonl')):
+            os.remove(path)
+        result = self.evaluator.evaluate(instrument(model, log_dir, self.trace_memory), data)
+        result['profile'] = report(log_dir)
+        return result
+
+    @property
+    def configuration(self):
+        return {
+            'wrapped_evaluator': self.evaluator.__class__.__name__,
+            'wrapped_configuration': self.evaluator.configuration,
+            'log_dir': self.log_dir,
+            'trace_memory': self.trace_memory,
+        }
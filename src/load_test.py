@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Sends synthetic posts to a scoring server (see serving.py) from concurrent
+clients and reports the latency and throughput they observed, followed by
+the counters of the server.
+
+usage: python load_test.py [--url URL | --socket PATH] [--clients N] [--requests N]
+                           [--documents N] [--characters N] [--tokens]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import socket
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    url = urlparse(args.url)
+    return http.client.HTTPConnection(url.hostname, url.port)
+
+
+def request(connection, method, path, content=None):
+    body = json.dumps(content).encode() if content is not None else None
+    connection.request(method, path, body, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def synthetic_posts(n_documents, n_characters, rng):
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz     '))
+    return [''.join(rng.choice(letters, n_characters)) for _ in range(n_documents)]
+
+
+def client(args, n_requests, seed):
+    """Sends requests one after another, returns their latencies and the number of errors."""
+    rng = np.random.default_rng(seed)
+    connection = connect(args)
+    latencies = []
+    errors = 0
+    for _ in range(n_requests):
+        posts = synthetic_posts(args.documents, args.characters, rng)
+        content = {'tokens': [post.split() for post in posts]} if args.tokens else {'bodies': posts}
+        start = time.perf_counter()
+        status, _ = request(connection, 'POST', '/predict', content)
+        latencies.append(time.perf_counter() - start)
+        errors += status != 200
+    connection.close()
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--socket', help='connect to this unix socket instead')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=100, help='per client')
+    parser.add_argument('--documents', type=int, default=1, help='per request')
+    parser.add_argument('--characters', type=int, default=1000, help='per document')
+    parser.add_argument('--tokens', action='store_true', help='send token lists instead of bodies')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        results = list(executor.map(lambda seed: client(args, args.requests, seed), range(args.clients)))
+    seconds = time.perf_counter() - start
+
+    latencies = np.concatenate([latencies for latencies, _ in results])
+    n_requests = len(latencies)
+    print(f'{args.clients} clients, {n_requests} requests of {args.documents} documents in {seconds:.2f}s')
+    print(f'{n_requests / seconds:.1f} requests/s, {n_requests * args.documents / seconds:.1f} documents/s, '
+          f'{sum(errors for _, errors in results)} errors')
+    print(f'latency p50 {np.percentile(latencies, 50) * 1000:.1f}ms, p90 {np.percentile(latencies, 90) * 1000:.1f}ms, '
+          f'p99 {np.percentile(latencies, 99) * 1000:.1f}ms')
+    connection = connect(args)
+    print('server:', json.dumps(request(connection, 'GET', '/stats')[1], indent=2))
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent listings of the corpus directories.
+
+All corpora are laid out as <root>/<author>/<language or category>/<file>,
+optionally with another sub directory (e.g., chunks) below the language. A
+CorpusManifest stores the listing of every directory it has visited together
+with the directory's mtime. Scanning a corpus again only costs one stat per
+directory, and only directories whose mtime changed (i.e., files were added,
+removed or renamed) are listed again. Changes to the content of a file that
+keep its name are not noticed.
+
+The manifests are kept outside of the corpora, so that writing them does not
+change the mtime of the corpus root and read-only corpora work as well.
+"""
+import hashlib
+import json
+import logging
+import os
+
+MANIFEST_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'corpus_manifests')
+MANIFEST_VERSION = 1
+
+
+class CorpusManifest:
+
+    def __init__(self, root, path=None):
+        """
+        :param root: the corpus directory
+        :param path: where to store the manifest, defaults to a file in
+                     MANIFEST_DIR named after the absolute corpus path
+        """
+        self.root = root
+        if path is None:
+            name = hashlib.blake2b(os.path.abspath(root).encode(), digest_size=16).hexdigest()
+            path = os.path.join(MANIFEST_DIR, f'{name}.json')
+        self.path = path
+        self.directories = {}
+        self.token_counts = {}
+        self.changed = False
+        try:
+            with open(self.path, 'r') as i_f:
+                manifest = json.load(i_f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.directories = manifest['directories']
+                self.token_counts = manifest.get('token_counts', {})
+        except (OSError, ValueError):
+            pass
+
+    def listdir(self, directory=''):
+        """
+        Returns the entries of a directory relative to the root as lists of
+        [name, is_dir, size, mtime], in the order the file system lists them.
+        Hidden entries are skipped, like glob does.
+        """
+        full_path = os.path.join(self.root, directory) if directory else self.root
+        mtime = os.stat(full_path).st_mtime_ns
+        cached = self.directories.get(directory)
+        if cached is not None and cached['mtime'] == mtime:
+            return cached['entries']
+
+        entries = []
+        with os.scandir(full_path) as iterator:
+            for entry in iterator:
+                if entry.name.startswith('.'):
+                    continue
+                stat = entry.stat()
+                entries.append([entry.name, entry.is_dir(), stat.st_size, stat.st_mtime])
+        self.directories[directory] = {'mtime': mtime, 'entries': entries}
+        self.changed = True
+        return entries
+
+    def subdirectories(self, directory=''):
+        return [name for name, is_dir, _, _ in self.listdir(directory) if is_dir]
+
+    def groups(self):
+        """Returns the names of all entries below the author directories."""
+        return {
+            name
+            for author in self.subdirectories()
+            for name, _, _, _ in self.listdir(author)
+        }
+
+    def documents(self, subdirectory=None):
+        """
+        Yields a record for every file in <root>/<author>/<group>/[subdirectory]
+        with its path, author, group (language or category), title (the file
+        name without extension), size and mtime.
+        """
+        for author in self.subdirectories():
+            for group in self.subdirectories(author):
+                directory = os.path.join(author, group)
+                if subdirectory is not None:
+                    if subdirectory not in self.subdirectories(directory):
+                        continue
+                    directory = os.path.join(directory, subdirectory)
+                for name, is_dir, size, mtime in self.listdir(directory):
+                    if is_dir:
+                        continue
+                    yield {
+                        'path': os.path.join(self.root, directory, name),
+                        'author': author,
+                        'group': group,
+                        'title': os.path.splitext(name)[0],
+                        'size': size,
+                        'mtime': mtime,
+                    }
+        self.save()
+
+    def token_count(self, record):
+        """
+        Returns the number of whitespace separated tokens of a document
+        record. The counts are kept as long as the size and mtime of the file
+        do not change. They are compared to a fresh stat of the file, since
+        editing a file does not change the mtime of its directory, so the
+        listing of the record may be outdated.
+        """
+        relative = os.path.relpath(record['path'], self.root)
+        stat = os.stat(record['path'])
+        cached = self.token_counts.get(relative)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+        with open(record['path'], 'r') as i_f:
+            count = len(i_f.read().split())
+        self.token_counts[relative] = [stat.st_size, stat.st_mtime, count]
+        self.changed = True
+        return count
+
+    def save(self):
+        """Writes the manifest if anything changed. Failing to do so is not fatal."""
+        if not self.changed:
+            return
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temporary, 'w') as o_f:
+                json.dump({
+                    'version': MANIFEST_VERSION,
+                    'directories': self.directories,
+                    'token_counts': self.token_counts,
+                }, o_f)
+            os.replace(temporary, self.path)
+            self.changed = False
+        except OSError as e:
+            logging.warning('could not write corpus manifest %s: %s', self.path, e)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Estimates of the peak memory of fitting and scoring a pipeline on one fold,
+see evaluators.MemoryBudgetCvGridEvaluator.
+
+The estimate of a task is a rough model of what a worker holds at once: the
+texts and tokens of its training or test documents, the Documents of the
+LifeVectorizer and the sample index arrays of the largest fragment size of
+one document. It is multiplied by a scale factor learnt from the peaks
+measured for earlier tasks, which are appended to a log file.
+"""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+from feature_extraction import LifeVectorizer
+from pipeline_tools import CustomCallbackTransformer, Tokenizer, parse_chunk_id
+from corpus import CompiledCorpusReader
+
+LOG_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'memory_estimates.jsonl')
+# what a forked worker allocates besides the documents, e.g., the forest
+BASE_BYTES = 64 * 2 ** 20
+# average bytes of a token and the whitespace after it, in the novels
+BYTES_PER_TOKEN = 6.0
+# bytes per token of the token lists passed to the LifeVectorizer
+TOKEN_BYTES = {
+    # int32 ids
+    'ids': 4,
+    # int32 ids mapped from a compiled corpus, no text is read
+    'mapped': 0,
+    # lists of str objects, one pointer and one small object per token
+    'strings': 64,
+    # the texts themselves, their characters are the tokens
+    'characters': 0,
+}
+# the scale factor before any peaks were measured
+DEFAULT_SCALE = 1.5
+
+
+def current_rss():
+    """The resident memory of this process, in bytes."""
+    try:
+        with open('/proc/self/statm', 'r') as i_f:
+            return int(i_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """The peak resident memory of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def token_representation(pipeline):
+    """How the pipeline passes tokens to its LifeVectorizer, see TOKEN_BYTES."""
+    for _, step in pipeline.steps:
+        if isinstance(step, CompiledCorpusReader):
+            return 'mapped'
+        if isinstance(step, Tokenizer):
+            return 'ids'
+        if isinstance(step, CustomCallbackTransformer):
+            return 'strings'
+        if isinstance(step, LifeVectorizer):
+            break
+    return 'characters'
+
+
+def document_sizes(documents, manifest=None):
+    """
+    Returns the sizes in bytes and the (estimated) numbers of tokens of
+    documents given as paths or chunk ids. If a CorpusManifest is given, the
+    sizes it recorded and the token counts it cached are used, otherwise the
+    files are stat'ed and the tokens estimated from the size. Documents that
+    are no files are taken as texts.
+    """
+    records = {}
+    if manifest is not None:
+        # the manifest lists <author>/<group>/<file> or, e.g., the chunks in
+        # <author>/<group>/chunks/<file>
+        subdirectories = set()
+        for document in documents:
+            parts = os.path.relpath(parse_chunk_id(document)[0], manifest.root).split(os.sep)
+            if len(parts) in (3, 4) and parts[0] != os.pardir:
+                subdirectories.add(parts[2] if len(parts) == 4 else None)
+        records = {
+            os.path.normpath(record['path']): record
+            for subdirectory in subdirectories
+            for record in manifest.documents(subdirectory)
+        }
+    sizes = np.zeros(len(documents))
+    tokens = np.zeros(len(documents))
+    stats = {}
+    for i, document in enumerate(documents):
+        path, start, stop = parse_chunk_id(document)
+        record = records.get(os.path.normpath(path))
+        if record is not None:
+            size = record['size']
+            cached = manifest.token_counts.get(os.path.relpath(path, manifest.root))
+            count = cached[2] if cached is not None and cached[:2] == [record['size'], record['mtime']] else None
+        else:
+            if path not in stats:
+                stats[path] = os.path.getsize(path) if os.path.isfile(path) else None
+            size, count = stats[path], None
+            if size is None:
+                size = len(str(document))
+        if count is None:
+            count = size / BYTES_PER_TOKEN
+        if start is not None:
+            # a chunk of the file
+            size, count = size * (stop - start) / max(count, 1), stop - start
+        sizes[i] = size
+        tokens[i] = count
+    return sizes, tokens
+
+
+def raw_estimate(sizes, tokens, representation, vectorizer):
+    """
+    The unscaled peak of transforming one set of documents, in bytes.
+
+    :param sizes: bytes of the documents
+    :param tokens: tokens of the documents
+    :param representation: see TOKEN_BYTES
+    :param vectorizer: the LifeVectorizer of the pipeline, or None
+    """
+    text = 0 if representation == 'mapped' else 2 * sizes.sum()
+    if representation == 'characters':
+        tokens = sizes
+    # a text is read and decoded at once, the Documents hold int32 ids and
+    # the frequencies
+    documents = text + tokens.sum() * (TOKEN_BYTES[representation] + 8)
+    samples = 0
+    if vectorizer is not None and len(tokens) and not vectorizer.analytic:
+        n_samples = vectorizer.sample_batch if vectorizer.tolerance is not None else vectorizer.samples
+        methods = 2 if vectorizer.sample_type == 'both' else 1
+        largest = min(max(vectorizer.fragment_sizes), tokens.max())
+        # the int64 positions of all samples and their counts
+        samples = 3 * 8 * n_samples * largest * methods
+    return BASE_BYTES + documents + samples
+
+
+class MemoryModel:
+
+    """
+    Scales the raw estimates by a factor learnt from measured peaks. The
+    factor is a high percentile of the ratios of the measured peaks to the
+    raw estimates of the last logged tasks, so that only few tasks exceed
+    their estimate.
+    """
+
+    def __init__(self, log_path=LOG_PATH, window=200, percentile=95, margin=1.1):
+        """
+        :param log_path: JSON lines file the measured peaks are appended to,
+                         None to neither read nor write one
+        :param window: number of recent tasks the factor is learnt from
+        :param percentile: of the ratios of peaks to raw estimates
+        :param margin: the factor is multiplied by this
+        """
+        self.log_path = log_path
+        self.window = window
+        self.percentile = percentile
+        self.margin = margin
+        self.ratios = []
+        if log_path is not None and os.path.isfile(log_path):
+            with open(log_path, 'r') as i_f:
+                for line in i_f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('peak') and record.get('raw_estimate'):
+                        self.ratios.append(record['peak'] / record['raw_estimate'])
+        self.ratios = self.ratios[-window:]
+
+    @property
+    def scale(self):
+        if len(self.ratios) < 5:
+            return DEFAULT_SCALE
+        return float(np.percentile(self.ratios, self.percentile)) * self.margin
+
+    def estimate(self, raw):
+        return raw * self.scale
+
+    def add(self, record):
+        """
+        Learns from and logs a finished task.
+
+        :param record: dict with at least raw_estimate and the measured peak
+                       in bytes
+        """
+        record = dict(record, time=time.time(), scale=self.scale)
+        if record.get('peak') and record.get('raw_estimate'):
+            self.ratios = (self.ratios + [record['peak'] / record['raw_estimate']])[-self.window:]
+        logging.info(
+            f'task peak {record.get("peak", 0) / 2 ** 20:.0f}MB, '
+            f'estimated {record.get("estimate", 0) / 2 ** 20:.0f}MB')
+        if self.log_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            with open(self.log_path, 'a') as o_f:
+                o_f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logging.warning('could not log the memory peak to %s: %s', self.log_path, e)
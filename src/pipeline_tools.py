@@ -1,13 +1,51 @@
 # -*- coding: utf-8 -*-
 from sklearn.base import BaseEstimator, TransformerMixin
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
 import os
 import json
+import re
+import unicodedata
 
-class CustomCallbackTransformer(BaseEstimator, TransformerMixin):
+import numpy as np
+from unidecode import unidecode
 
-    def __init__(self, callback, per_document=True):
+
+class StatelessMixin:
+
+    """
+    Marks a transformer whose fit learns nothing, so that its output for a
+    document does not depend on the documents it was fitted on. The
+    PrefixSharingCvGridEvaluator relies on this to compute such steps once.
+    """
+
+    def _more_tags(self):
+        return {'stateless': True, 'requires_fit': False}
+
+    def __sklearn_tags__(self):
+        tags = super().__sklearn_tags__()
+        tags.requires_fit = False
+        return tags
+
+
+def stream(documents, lazy):
+    """
+    Returns the generator of transformed documents as is if the transformer
+    is lazy, otherwise as a list. With lazy transformers, a pipeline hands the
+    documents from step to step one at a time, so that the steps never hold
+    the whole corpus at once.
+    """
+    return documents if lazy else list(documents)
+
+
+class CustomCallbackTransformer(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    def __init__(self, callback, per_document=True, lazy=False):
         self.callback = callback
         self.per_document = per_document
+        self.lazy = lazy
 
     def fit(self, X, y=None):
         return self
@@ -15,71 +53,410 @@ class CustomCallbackTransformer(BaseEstimator, TransformerMixin):
     def transform(self, X, y=None):
         if not self.per_document:
             return self.callback(X)
-        ret = []
-        for document in X:
-            ret.append(self.callback(document))
-        return ret
+        return stream((self.callback(document) for document in X), self.lazy)
 
 
 # -*- coding: utf-8 -*-
 
-class FileReader(BaseEstimator, TransformerMixin):
+class FileReader(StatelessMixin, BaseEstimator, TransformerMixin):
 
     """
     Transforms filenames into their content.
     By default, this transformer will open files in text mode.
 
     input: list of paths
-    output: list of contents of the files specified by the paths
+    output: list of contents of the files specified by the paths, or a
+            generator of them if lazy is set
     """
 
-    def __init__(self, mode='r'):
+    def __init__(self, mode='r', lazy=False):
         self.mode = mode
+        self.lazy = lazy
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        ret = []
+        return stream((self._read(document) for document in X), self.lazy)
+
+    def _read(self, document):
+        if not os.path.isfile(document):
+            raise Exception('NO SUCH FILE: ', document)
+        with open(document, self.mode) as i_f:
+            return i_f.read()
+
+
+def chunk_id(path, start, stop):
+    """Names the tokens start to stop of a file, see ChunkReader."""
+    return f'{path}#{start}:{stop}'
+
+
+def parse_chunk_id(document):
+    """
+    Returns the path, start and stop of a chunk id, or the document and
+    None, None if it is a plain path.
+    """
+    path, separator, span = str(document).rpartition('#')
+    start, colon, stop = span.partition(':')
+    if not separator or not colon or not start.isdigit() or not stop.isdigit():
+        return str(document), None, None
+    return path, int(start), int(stop)
+
+
+class ChunkReader(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    """
+    Transforms virtual chunks, i.e., ids of the form path#start:stop as
+    generated by a NovelsLoader with a chunk_size, into the whitespace
+    separated tokens start to stop of the file. Plain paths are read as a
+    whole. Each file is read and split only once for all of its chunks that
+    follow each other.
+
+    input: list of chunk ids or paths
+    output: list of the texts of the chunks (the tokens joined by single
+            spaces), or of their token lists if split is set, or a
+            generator of them if lazy is set
+    """
+
+    def __init__(self, split=False, lazy=False):
+        self.split = split
+        self.lazy = lazy
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        return stream(self._read_chunks(X), self.lazy)
+
+    def _read_chunks(self, X):
+        source, tokens = None, None
         for document in X:
-            if not os.path.isfile(document):
-                raise Exception('NO SUCH FILE: ', document)
-            with open(document, self.mode) as i_f:
-                ret.append(i_f.read())
-        return ret
+            path, start, stop = parse_chunk_id(document)
+            if path != source:
+                if not os.path.isfile(path):
+                    raise Exception('NO SUCH FILE: ', path)
+                with open(path, 'r') as i_f:
+                    source, tokens = path, i_f.read().split()
+            if stop is not None and stop > len(tokens):
+                raise ValueError(f'{document} ends after the {len(tokens)} tokens of the file, was it changed?')
+            chunk = tokens[start:stop]
+            yield chunk if self.split else ' '.join(chunk)
+
 
-class DictFieldTransformer(BaseEstimator, TransformerMixin):
+class DictFieldTransformer(StatelessMixin, BaseEstimator, TransformerMixin):
 
     """
     extracts a field from a json object.
     This transformer expects json strings as input, not parsed dictionaries.
     """
 
-    def __init__(self, field_name):
+    def __init__(self, field_name, lazy=False):
 
         """
         :param field_name: the field to extract from the string
+        :param lazy: return a generator instead of a list
         """
         self.field_name = field_name
+        self.lazy = lazy
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        ret = []
-        for document in X:
-            ret.append(document[self.field_name])
-        return ret
+        return stream((document[self.field_name] for document in X), self.lazy)
 
     
-class JsonTransformer(BaseEstimator, TransformerMixin):
+class JsonTransformer(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        ret = []
-        for document in X:
-            ret.append(json.loads(document))
-            
+        return stream((json.loads(document) for document in X), self.lazy)
+
+
+
+def shard_path(shard_dir, category_dir):
+    """
+    The JSON-lines shard holding the posts of <root>/<author>/<category>.
+    """
+    author = os.path.basename(os.path.dirname(category_dir))
+    return os.path.join(shard_dir, author, f'{os.path.basename(category_dir)}.jsonl')
+
+
+class JsonFieldReader(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    """
+    Transforms paths of JSON files into the values of some of their fields.
+    This replaces FileReader -> JsonTransformer -> DictFieldTransformer, but
+    never keeps more than the projected fields of a document. The files are
+    opened by a pool of threads to hide the I/O latency.
+
+    If shard_dir is set, posts are read from the JSON-lines shards written
+    by dataloader_reddit.pack_shards where available, which saves opening
+    every single file. A post is only taken from its shard if its size and
+    mtime did not change since it was packed, which costs one stat per post
+    instead of opening it. Other posts are read from their files.
+
+    input: list of paths
+    output: list of field values (a dict of values if fields is a list), or
+            a generator of them if lazy is set
+    """
+
+    def __init__(self, fields='body', n_threads=8, shard_dir=None, batch_size=1024, lazy=False):
+        self.fields = fields
+        self.n_threads = n_threads
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.lazy = lazy
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        return stream(self._read_batches(X), self.lazy)
+
+    def project(self, post):
+        if isinstance(self.fields, str):
+            return post[self.fields]
+        return {field: post[field] for field in self.fields}
+
+    def _read_batches(self, X):
+        documents = iter(X)
+        # the projected posts of the last shard, the paths usually come
+        # grouped by category
+        shard = (None, {})
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            while True:
+                batch = list(itertools.islice(documents, self.batch_size))
+                if not batch:
+                    return
+                values = {}
+                missing = []
+                for document in batch:
+                    category_dir = os.path.dirname(document)
+                    if self.shard_dir is not None and shard[0] != category_dir:
+                        shard = (category_dir, self._read_shard(category_dir))
+                    if document in shard[1]:
+                        values[document] = shard[1][document]
+                    else:
+                        missing.append(document)
+                values.update(zip(missing, executor.map(self._read_file, missing)))
+                for document in batch:
+                    yield values[document]
+
+    def _read_file(self, document):
+        if not os.path.isfile(document):
+            raise Exception('NO SUCH FILE: ', document)
+        with open(document, 'r') as i_f:
+            return self.project(json.load(i_f))
+
+    def _read_shard(self, category_dir):
+        path = shard_path(self.shard_dir, category_dir)
+        if not os.path.isfile(path):
+            return {}
+        # editing a post does not change the mtime of its directory, so every
+        # post is compared to its file
+        with os.scandir(category_dir) as iterator:
+            stats = {entry.name: entry.stat() for entry in iterator}
+        ret = {}
+        with open(path, 'r') as i_f:
+            for line in i_f:
+                entry = json.loads(line)
+                stat = stats.get(entry['name'])
+                if stat is None or [stat.st_size, stat.st_mtime_ns] != [entry.get('size'), entry.get('mtime')]:
+                    continue
+                ret[os.path.join(category_dir, entry['name'])] = self.project(entry['post'])
         return ret
+
+
+# the bytes str.split() splits at, and the other characters it splits at
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+_UNICODE_WHITESPACE = '\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'
+_UNICODE_WHITESPACE_PATTERN = re.compile(f'[{_UNICODE_WHITESPACE}]')
+# _BYTE_MASKS[k] keeps the first k bytes of a little-endian word
+_BYTE_MASKS = np.array([(1 << 8 * k) - 1 for k in range(8)] + [2 ** 64 - 1], dtype=np.uint64)
+_PRIME = np.uint64(0x100000001b3)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+# short documents are tokenized together up to this many bytes, sorting
+# larger arrays gets slower per token
+_BATCH_BYTES = 2 ** 20
+
+# token ids of the documents tokenized by this process, by normalization and
+# content hash, least recently used first
+_MEMO = OrderedDict()
+_memo_bytes = 0
+
+
+def _remember(key, ids, max_bytes):
+    global _memo_bytes
+    if ids.nbytes > max_bytes:
+        return
+    _MEMO[key] = ids
+    _memo_bytes += ids.nbytes
+    while _memo_bytes > max_bytes:
+        _memo_bytes -= _MEMO.popitem(last=False)[1].nbytes
+
+
+def encoded_token_ids(encoded):
+    """
+    Splits UTF-8 encoded documents at ASCII whitespace, like str.split does,
+    and returns the int32 ids of their tokens. The ids of a document are
+    numbered in order of first occurrence, like feature_extraction.token_ids
+    numbers them, so the LifeVectorizer takes them as they are.
+
+    All documents are processed at once with numpy. A token is identified by
+    a 64 bit hash of its bytes (tokens of up to 8 bytes are taken as they
+    are), the chance of two of the types of a document colliding is
+    negligible.
+
+    :param encoded: list of bytes
+    :return: list of int32 arrays
+    """
+    if not encoded:
+        return []
+    data = b' '.join(encoded) + b'\0' * 16
+    n = len(data) - 16
+    whitespace = np.ones(n + 2, dtype=bool)
+    b = np.frombuffer(data, dtype=np.uint8, count=n)
+    np.less_equal(b, 32, out=whitespace[1:-1])
+    # control characters other than whitespace are rare
+    if np.any(b < 9) or np.any(b - np.uint8(14) < 14):
+        np.take(_WHITESPACE, b, out=whitespace[1:-1])
+    edges = np.flatnonzero(whitespace[1:] != whitespace[:-1])
+    starts = edges[0::2]
+    lengths = edges[1::2] - starts
+    if not len(starts):
+        return [np.zeros(0, dtype=np.int32) for _ in encoded]
+
+    # the 8 bytes from every position, unaligned, the padding covers the end
+    words = np.ndarray((n + 9,), dtype='<u8', buffer=data, strides=(1,))
+    hashes = words[starts] & _BYTE_MASKS[np.minimum(lengths, 8)]
+    hashes *= _PRIME
+    hashes += words[starts + 8] & _BYTE_MASKS[np.clip(lengths - 8, 0, 8)]
+    hashes ^= lengths.astype(np.uint64)
+    long = np.flatnonzero(lengths > 16)
+    offset = 16
+    while len(long):
+        rest = lengths[long] - offset
+        hashes[long] = hashes[long] * _PRIME + (words[starts[long] + offset] & _BYTE_MASKS[np.minimum(rest, 8)])
+        long = long[rest > 8]
+        offset += 8
+
+    # the same token in different documents is a different type
+    document_starts = np.cumsum([0] + [len(e) + 1 for e in encoded[:-1]])
+    documents = np.searchsorted(document_starts, starts, side='right') - 1
+    hashes ^= documents.astype(np.uint64) * _GOLDEN
+
+    # number the types in order of their first occurrence
+    order = np.argsort(hashes)
+    sorted_hashes = hashes[order]
+    new = np.empty(len(order), dtype=bool)
+    new[0] = True
+    np.not_equal(sorted_hashes[1:], sorted_hashes[:-1], out=new[1:])
+    first = np.minimum.reduceat(order, np.flatnonzero(new))
+    rank = np.empty(len(first), dtype=np.int32)
+    rank[np.argsort(first)] = np.arange(len(first), dtype=np.int32)
+    ids = np.empty(len(order), dtype=np.int32)
+    ids[order] = rank[np.cumsum(new) - 1]
+
+    # the types of a document are numbered after those of the ones before
+    bounds = np.searchsorted(documents, np.arange(len(encoded) + 1))
+    ids -= ids[bounds[documents]]
+    return [ids[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class Tokenizer(StatelessMixin, BaseEstimator, TransformerMixin):
+
+    """
+    Splits texts at whitespace, like CustomCallbackTransformer(lambda x:
+    x.split()), but returns the tokens as int32 id arrays instead of lists of
+    strings, see encoded_token_ids. The LifeVectorizer gives the same
+    features for both.
+
+    The texts are tokenized in batches. The ids of the last documents are
+    kept in memory by their content, so that a grid search tokenizes every
+    document once per process instead of once per candidate and fold. The
+    arrays are read-only.
+
+    input: list of texts
+    output: list of int32 arrays, or a generator of them if lazy is set
+    """
+
+    def __init__(self, normalization=None, batch_size=64, memo_bytes=2 ** 25, lazy=False):
+        """
+        :param normalization: None, 'unidecode' (transliterate to ASCII) or
+                              a unicodedata form, e.g., 'NFKC'
+        :param batch_size: number of documents tokenized at once
+        :param memo_bytes: the size the memoized ids are trimmed to, 0
+                           disables the memo. Every process keeps its own
+                           memo, e.g., every worker of a grid search.
+        :param lazy: return a generator instead of a list
+        """
+        self.normalization = normalization
+        self.batch_size = batch_size
+        self.memo_bytes = memo_bytes
+        self.lazy = lazy
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        return stream(self._tokenize_batches(X), self.lazy)
+
+    def normalize(self, text):
+        if self.normalization == 'unidecode':
+            text = unidecode(text)
+        elif self.normalization is not None:
+            text = unicodedata.normalize(self.normalization, text)
+        # byte-wise, only ASCII whitespace is recognized
+        if not text.isascii() and any(c in text for c in _UNICODE_WHITESPACE):
+            text = _UNICODE_WHITESPACE_PATTERN.sub(' ', text)
+        return text
+
+    @staticmethod
+    def _parts(encoded):
+        part, size = [], 0
+        for key, data in encoded.items():
+            if part and size + len(data) > _BATCH_BYTES:
+                yield part
+                part, size = [], 0
+            part.append(key)
+            size += len(data)
+        if part:
+            yield part
+
+    def _tokenize_batches(self, X):
+        documents = iter(X)
+        while True:
+            batch = list(itertools.islice(documents, self.batch_size))
+            if not batch:
+                return
+            keys = []
+            found = {}
+            missing = {}
+            for document in batch:
+                data = document.encode('utf-8', 'surrogatepass')
+                key = (self.normalization, hashlib.blake2b(data, digest_size=16).digest())
+                keys.append(key)
+                if key in found or key in missing:
+                    continue
+                if self.memo_bytes and key in _MEMO:
+                    _MEMO.move_to_end(key)
+                    found[key] = _MEMO[key]
+                    continue
+                normalized = self.normalize(document)
+                if normalized != document:
+                    data = normalized.encode('utf-8', 'surrogatepass')
+                missing[key] = data
+            for part in self._parts(missing):
+                for key, ids in zip(part, encoded_token_ids([missing[key] for key in part])):
+                    ids.flags.writeable = False
+                    found[key] = ids
+                    _remember(key, ids, self.memo_bytes)
+            for key in keys:
+                yield found[key]
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable runs of a config, split into independent tasks.
+
+Instead of one grid search per loader, a config is expanded into one task
+per (loader, fold, grid candidate). Every task fits the pipeline once and
+stores its test score in a store directory, which checkpoints the run:
+running it again only executes the tasks that have no result yet. Any number
+of workers can work on the same store, processes on the same host as well
+as hosts sharing the directory (e.g., via NFS), as long as the corpora have
+the same paths everywhere.
+
+The store directory contains:
+    tasks.json   the tasks of the config, written by the first worker
+    claims/      one file per task in progress, a worker that stops renewing
+                 its claim for longer than the lease loses it
+    results/     one JSON file per finished task
+    failures/    one JSON file per failed task, with the traceback. Failed
+                 tasks are only retried with --retry-failed.
+
+collect assembles the results into the outcome a GridEvaluator would have
+returned for every loader, and passes it to the result handlers of the
+config.
+
+usage: python scheduler.py run CONFIG STORE [--workers N] [--lease SECONDS] [--retry-failed]
+       python scheduler.py status STORE
+       python scheduler.py collect CONFIG STORE [--output FILE]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+from dbispipeline.evaluators import CustomCvGridEvaluator, FixedSplitGridEvaluator, GridEvaluator
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+
+from evaluators import grid_outcome
+from feature_cache import content_hash
+from feature_store import stable_repr
+
+# the data and folds of the loaders this process has worked on, by config
+# and loader index
+_DATA = {}
+
+
+def load_config(path):
+    """Imports a config module, like dbispipeline does with a plan."""
+    spec = importlib.util.spec_from_file_location('plan', path)
+    plan = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plan)
+    for member in ['dataloader', 'pipeline', 'evaluator']:
+        if not hasattr(plan, member):
+            raise ValueError(f'{path} is not a valid config, {member} is missing')
+    return plan
+
+
+def config_hash(path):
+    with open(path, 'rb') as i_f:
+        return content_hash(i_f.read())
+
+
+def flatten_loaders(loader):
+    """Returns the loaders of a (nested) MultiLoaderWrapper, in order."""
+    if not loader.is_multiloader:
+        return [loader]
+    return [leaf for inner in loader.loaders for leaf in flatten_loaders(inner)]
+
+
+def grid_evaluator(evaluator):
+    """Returns the GridEvaluator of a config, unwrapping, e.g., a ProfilingEvaluator."""
+    while not isinstance(evaluator, GridEvaluator):
+        if not hasattr(evaluator, 'evaluator'):
+            raise ValueError(f'cannot split {type(evaluator).__name__} into tasks, it is no GridEvaluator')
+        evaluator = evaluator.evaluator
+    return evaluator
+
+
+def split_data(evaluator, pipeline, data):
+    """
+    Returns the documents, labels and folds of the data of a loader, in the
+    way the evaluator of the config interprets them.
+    """
+    if isinstance(evaluator, FixedSplitGridEvaluator):
+        (x_train, y_train), (x_test, y_test) = data[0], data[-1]
+        x = np.concatenate((np.asarray(x_train), np.asarray(x_test)))
+        y = np.concatenate((np.asarray(y_train), np.asarray(y_test)))
+        folds = [(np.arange(len(x_train)), np.arange(len(x_train), len(x)))]
+        return x, y, folds
+    if isinstance(evaluator, CustomCvGridEvaluator):
+        x, y, cv = data
+    else:
+        x, y = data
+        cv = evaluator.grid_parameters.get('cv')
+    x, y = np.asarray(x), np.asarray(y)
+    cv = check_cv(cv, y, classifier=is_classifier(pipeline))
+    return x, y, list(cv.split(x, y))
+
+
+def fold_key(x, test):
+    """Identifies a fold by its test documents, independent of their order."""
+    return content_hash(sorted(str(document) for document in x[test]))[:16]
+
+
+def expand(plan):
+    """Returns the tasks of a config, grouped by loader and fold."""
+    evaluator = grid_evaluator(plan.evaluator)
+    candidates = list(ParameterGrid(evaluator.parameters))
+    tasks = []
+    for loader_index, loader in enumerate(flatten_loaders(plan.dataloader)):
+        x, _, folds = split_data(evaluator, plan.pipeline, loader.load())
+        for fold_index, (_, test) in enumerate(folds):
+            for candidate_index, params in enumerate(candidates):
+                tasks.append({
+                    'id': f'{loader_index}-{fold_index}-{candidate_index}',
+                    'loader': loader_index,
+                    'fold': fold_index,
+                    'fold_key': fold_key(x, test),
+                    'candidate': candidate_index,
+                    'params': params,
+                })
+    return tasks
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return stable_repr(value)
+
+
+def _write_json(path, value):
+    temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as o_f:
+        json.dump(value, o_f, default=_json_default)
+    os.replace(temporary, path)
+
+
+class TaskStore:
+
+    """
+    The tasks, claims and results of a run in a directory. All writes are
+    atomic, so that workers on several hosts can share it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for subdirectory in ['claims', 'results', 'failures']:
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def _path(self, kind, task_id):
+        return os.path.join(self.directory, kind, f'{task_id}.json')
+
+    def tasks(self, config, plan):
+        """
+        Returns the tasks of the store. They are expanded from the config if
+        the store is new, and the store must not belong to another config.
+        """
+        path = os.path.join(self.directory, 'tasks.json')
+        digest = config_hash(config)
+        if not os.path.isfile(path):
+            logging.info(f'expanding the tasks of {config}')
+            # the fold indices of the task ids depend on the order the loader
+            # lists the documents in, which may differ between hosts. Only
+            # the first host to finish expanding gets to write the tasks, the
+            # others use its tasks.
+            temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+            _write_json(temporary, {'config': config, 'config_hash': digest, 'tasks': expand(plan)})
+            try:
+                os.link(temporary, path)
+            except FileExistsError:
+                logging.info('another worker expanded the tasks first, using its tasks')
+            finally:
+                os.remove(temporary)
+        with open(path, 'r') as i_f:
+            stored = json.load(i_f)
+        if stored['config_hash'] != digest:
+            raise ValueError(f'{self.directory} holds the tasks of another version of {stored["config"]}')
+        return stored['tasks']
+
+    def ids(self, kind):
+        """Returns the ids of the tasks with a file of a kind, e.g., 'results'."""
+        return {
+            name[:-len('.json')]
+            for name in os.listdir(os.path.join(self.directory, kind))
+            if name.endswith('.json')
+        }
+
+    def finished(self):
+        """Returns the ids of the tasks with a result or failure."""
+        return self.ids('results') | self.ids('failures')
+
+    def is_finished(self, task_id):
+        return os.path.isfile(self._path('results', task_id)) or os.path.isfile(self._path('failures', task_id))
+
+    def results(self):
+        """Returns {task id: result} of all finished tasks."""
+        ret = {}
+        directory = os.path.join(self.directory, 'results')
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), 'r') as i_f:
+                    ret[os.path.splitext(name)[0]] = json.load(i_f)
+        return ret
+
+    def put_result(self, task_id, result):
+        _write_json(self._path('results', task_id), result)
+
+    def put_failure(self, task_id, failure):
+        _write_json(self._path('failures', task_id), failure)
+
+    def clear_failures(self):
+        directory = os.path.join(self.directory, 'failures')
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    def claim(self, task_id, lease):
+        """
+        Claims a task for this process, returns False if another worker holds
+        it. A claim whose file was not renewed for lease seconds is broken,
+        as well as the claim of a process of this host that does not exist
+        anymore.
+        """
+        path = self._path('claims', task_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            pass
+        else:
+            if time.time() - stat.st_mtime < lease and not self._orphaned(path):
+                return False
+            # only one of the workers breaking a claim gets to rename it
+            stale = f'{path}.{uuid.uuid4().hex}'
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return False
+            moved = os.stat(stale)
+            if (moved.st_ino, moved.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+                # another worker claimed it in the meantime, give it back
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            logging.warning(f'broke the stale claim of task {task_id}')
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as o_f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time()}, o_f)
+        return True
+
+    @staticmethod
+    def _orphaned(path):
+        try:
+            with open(path, 'r') as i_f:
+                owner = json.load(i_f)
+        except (OSError, ValueError):
+            # not written completely yet, or released
+            return False
+        if owner['host'] != socket.gethostname():
+            return False
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def renew(self, task_id):
+        try:
+            os.utime(self._path('claims', task_id))
+        except FileNotFoundError:
+            pass
+
+    def release(self, task_id):
+        try:
+            os.remove(self._path('claims', task_id))
+        except FileNotFoundError:
+            pass
+
+
+class _Heartbeat:
+
+    """Renews the claim of a task while it runs."""
+
+    def __init__(self, store, task_id, interval):
+        self.store = store
+        self.task_id = task_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.store.renew(self.task_id)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def _loader_data(plan, digest, loader_index):
+    key = (digest, loader_index)
+    if key not in _DATA:
+        evaluator = grid_evaluator(plan.evaluator)
+        loader = flatten_loaders(plan.dataloader)[loader_index]
+        x, y, folds = split_data(evaluator, plan.pipeline, loader.load())
+        _DATA[key] = (x, y, {fold_key(x, test): (train, test) for train, test in folds})
+    return _DATA[key]
+
+
+def run_task(plan, digest, task):
+    """Fits the pipeline with the parameters of a task on its fold and scores it."""
+    evaluator = grid_evaluator(plan.evaluator)
+    x, y, folds = _loader_data(plan, digest, task['loader'])
+    if task['fold_key'] not in folds:
+        raise ValueError(f'loader {task["loader"]} returned other documents than when the tasks were expanded')
+    train, test = folds[task['fold_key']]
+    params = list(ParameterGrid(evaluator.parameters))[task['candidate']]
+    estimator = clone(plan.pipeline).set_params(**params)
+    scoring = evaluator.grid_parameters.get('scoring')
+    if not (scoring is None or isinstance(scoring, str) or callable(scoring)):
+        raise ValueError('only a single scoring is supported')
+
+    start = time.perf_counter()
+    estimator.fit(x[train], y[train])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    score = check_scoring(estimator, scoring=scoring)(estimator, x[test], y[test])
+    return {
+        'task': task['id'],
+        'test_score': float(score),
+        'fit_time': fit_time,
+        'score_time': time.perf_counter() - start,
+        'n_train': len(train),
+        'n_test': len(test),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'finished': time.time(),
+    }
+
+
+def work(config, directory, lease=600, poll=30):
+    """
+    Runs the tasks of a config that nobody else works on until all are
+    finished, waiting for the tasks claimed by other workers in case they
+    die.
+
+    :param config: path of the config module
+    :param directory: the store directory
+    :param lease: seconds after which the claim of a worker that stopped
+                  renewing it is broken
+    :param poll: seconds between looking for unclaimed tasks
+    :return: the number of tasks run by this worker
+    """
+    plan = load_config(config)
+    store = TaskStore(directory)
+    tasks = store.tasks(config, plan)
+    digest = config_hash(config)
+    n_run = 0
+    while True:
+        finished = store.finished()
+        pending = [task for task in tasks if task['id'] not in finished]
+        if not pending:
+            return n_run
+        claimed = False
+        for task in pending:
+            if store.is_finished(task['id']) or not store.claim(task['id'], lease):
+                continue
+            claimed = True
+            logging.info(f'running task {task["id"]}: {task["params"]}')
+            try:
+                with _Heartbeat(store, task['id'], lease / 4):
+                    result = run_task(plan, digest, task)
+                store.put_result(task['id'], result)
+                n_run += 1
+            except Exception as e:
+                logging.exception(f'task {task["id"]} failed')
+                store.put_failure(task['id'], {
+                    'task': task['id'],
+                    'error': repr(e),
+                    'traceback': traceback.format_exc(),
+                    'host': socket.gethostname(),
+                })
+            finally:
+                store.release(task['id'])
+        if not claimed:
+            time.sleep(poll)
+
+
+def status(directory):
+    """Returns the number of tasks per state."""
+    with open(os.path.join(directory, 'tasks.json'), 'r') as i_f:
+        tasks = json.load(i_f)['tasks']
+    store = TaskStore(directory)
+    results, failures, claims = store.ids('results'), store.ids('failures'), store.ids('claims')
+    counts = {'tasks': len(tasks), 'finished': 0, 'failed': 0, 'running': 0, 'pending': 0}
+    for task in tasks:
+        if task['id'] in results:
+            counts['finished'] += 1
+        elif task['id'] in failures:
+            counts['failed'] += 1
+        elif task['id'] in claims:
+            counts['running'] += 1
+        else:
+            counts['pending'] += 1
+    return counts
+
+
+def collect(config, directory):
+    """
+    Assembles the results of every loader into the outcome of a
+    GridEvaluator without refit. Folds without a result are left out of the
+    means, their number is given as missing_tasks.
+
+    :return: list of {'dataloader': configuration, 'outcome': outcome}
+    """
+    plan = load_config(config)
+    store = TaskStore(directory)
+    tasks = store.tasks(config, plan)
+    results = store.results()
+    evaluator = grid_evaluator(plan.evaluator)
+    candidates = list(ParameterGrid(evaluator.parameters))
+
+    ret = []
+    for loader_index, loader in enumerate(flatten_loaders(plan.dataloader)):
+        loader_tasks = [task for task in tasks if task['loader'] == loader_index]
+        n_folds = max((task['fold'] + 1 for task in loader_tasks), default=0)
+        scores = np.full((len(candidates), n_folds), np.nan)
+        fit_times = np.full_like(scores, np.nan)
+        score_times = np.full_like(scores, np.nan)
+        for task in loader_tasks:
+            result = results.get(task['id'])
+            if result is not None:
+                scores[task['candidate'], task['fold']] = result['test_score']
+                fit_times[task['candidate'], task['fold']] = result['fit_time']
+                score_times[task['candidate'], task['fold']] = result['score_time']
+
+        outcome = grid_outcome(candidates, scores, fit_times, score_times, skip_missing=True)
+        outcome['missing_tasks'] = int(np.isnan(scores).sum())
+        ret.append({'dataloader': loader.configuration, 'outcome': outcome})
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run')
+    run.add_argument('config')
+    run.add_argument('store')
+    run.add_argument('--workers', type=int, default=1, help='worker processes on this host')
+    run.add_argument('--lease', type=float, default=600)
+    run.add_argument('--poll', type=float, default=30)
+    run.add_argument('--retry-failed', action='store_true')
+    show = subparsers.add_parser('status')
+    show.add_argument('store')
+    gather = subparsers.add_parser('collect')
+    gather.add_argument('config')
+    gather.add_argument('store')
+    gather.add_argument('--output', help='write the outcomes to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+
+    if args.command == 'run':
+        if args.retry_failed:
+            TaskStore(args.store).clear_failures()
+        # the first worker expands the tasks before the others start
+        TaskStore(args.store).tasks(args.config, load_config(args.config))
+        with ProcessPoolExecutor(args.workers) as executor:
+            futures = [
+                executor.submit(work, args.config, args.store, args.lease, args.poll)
+                for _ in range(args.workers)
+            ]
+            n_run = sum(future.result() for future in futures)
+        print(f'ran {n_run} tasks')
+        print(status(args.store))
+    elif args.command == 'status':
+        print(status(args.store))
+    else:
+        outcomes = collect(args.config, args.store)
+        plan = load_config(args.config)
+        for entry in outcomes:
+            print(f'{entry["dataloader"]}: best score {entry["outcome"]["best_score"]} with '
+                  f'{entry["outcome"]["best_params"]}, {entry["outcome"]["missing_tasks"]} tasks missing')
+            for handler in getattr(plan, 'result_handlers', []):
+                handler(entry['outcome'])
+        if args.output:
+            with open(args.output, 'w') as o_f:
+                json.dump(outcomes, o_f, default=_json_default)
+
+
+if __name__ == '__main__':
+    main()
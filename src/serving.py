@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Scores documents with a trained pipeline over HTTP.
+
+The server loads a pickled, fitted pipeline (e.g., the FileReader,
+JsonTransformer, DictFieldTransformer, LifeVectorizer and
+RandomForestClassifier of config_reddit.py) and accepts the documents
+themselves instead of paths:
+    POST /predict  {"bodies": ["text", ...]} enters the pipeline after its
+                   reading steps, {"tokens": [["a", "b"], ...]} enters it at
+                   the LifeVectorizer. Add "probabilities": true to get the
+                   class probabilities as well.
+    GET /stats     latency percentiles, throughput and batch sizes
+
+Concurrent requests are coalesced into micro-batches: a request waits at most
+the latency budget for others to arrive before its batch is scored, so the
+features and the forest prediction run once per batch instead of once per
+request.
+
+usage: python serving.py MODEL [--host HOST] [--port PORT | --socket PATH]
+                         [--max-batch N] [--latency-budget MILLISECONDS]
+"""
+import argparse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import pickle
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from corpus import CompiledCorpusReader
+from feature_extraction import LifeVectorizer
+from pipeline_tools import ChunkReader, DictFieldTransformer, FileReader, JsonFieldReader, JsonTransformer
+
+# steps that turn paths into texts, they are skipped for bodies
+READERS = (FileReader, JsonTransformer, DictFieldTransformer, JsonFieldReader, ChunkReader, CompiledCorpusReader)
+
+
+class ScoringModel:
+
+    """
+    A fitted pipeline that is entered at different steps depending on the
+    kind of input.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        steps = [step for _, step in pipeline.steps]
+        body_entry = 0
+        while body_entry < len(steps) - 1 and isinstance(steps[body_entry], READERS):
+            body_entry += 1
+        token_entry = next((i for i, step in enumerate(steps) if isinstance(step, LifeVectorizer)), None)
+        self.entries = {'bodies': body_entry, 'tokens': token_entry}
+
+    @property
+    def classes(self):
+        return self.pipeline.steps[-1][1].classes_
+
+    def predict(self, kind, documents, probabilities=False):
+        """
+        :return: predictions, and the class probabilities if requested
+        """
+        entry = self.entries[kind]
+        if entry is None:
+            raise ValueError(f'the pipeline takes no {kind}, it has no LifeVectorizer')
+        features = documents
+        if entry < len(self.pipeline) - 1:
+            features = self.pipeline[entry:-1].transform(documents)
+        estimator = self.pipeline.steps[-1][1]
+        return estimator.predict(features), estimator.predict_proba(features) if probabilities else None
+
+
+class Stats:
+
+    """Latency and throughput counters of the requests answered lately."""
+
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # (finished, latency, documents) of the last requests
+        self.requests = deque(maxlen=window)
+        self.batches = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_documents = 0
+        self.n_errors = 0
+
+    def add_batch(self, n_documents, seconds):
+        with self.lock:
+            self.batches.append((n_documents, seconds))
+
+    def add_request(self, latency, n_documents, failed=False):
+        with self.lock:
+            self.requests.append((time.time(), latency, n_documents))
+            self.n_requests += 1
+            self.n_documents += n_documents
+            self.n_errors += failed
+
+    def snapshot(self, recent=10.0):
+        """
+        :param recent: seconds over which the current throughput is measured
+        """
+        with self.lock:
+            requests = list(self.requests)
+            batches = list(self.batches)
+            uptime = time.time() - self.started
+            ret = {
+                'uptime': uptime,
+                'requests': self.n_requests,
+                'documents': self.n_documents,
+                'errors': self.n_errors,
+                'requests_per_second': self.n_requests / uptime,
+                'documents_per_second': self.n_documents / uptime,
+            }
+        latencies = np.array([latency for _, latency, _ in requests])
+        now = time.time()
+        ret.update({
+            'latency_p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+            'recent_documents_per_second': sum(n for finished, _, n in requests if finished > now - recent) / recent,
+            'mean_batch_size': float(np.mean([n for n, _ in batches])) if batches else None,
+            'mean_batch_ms': float(np.mean([s for _, s in batches]) * 1000) if batches else None,
+        })
+        return ret
+
+
+class _Request:
+
+    def __init__(self, kind, documents, probabilities):
+        self.kind = kind
+        self.documents = documents
+        self.probabilities = probabilities
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+
+    """
+    Scores the requests of all connections in one thread, in batches of up
+    to max_batch documents. The first request of a batch waits at most
+    latency_budget seconds for others to join, the budget does not include
+    the time to score the batch.
+    """
+
+    def __init__(self, model, max_batch=64, latency_budget=0.005, stats=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.latency_budget = latency_budget
+        self.stats = stats or Stats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def score(self, kind, documents, probabilities=False):
+        """Blocks until the documents are scored, returns (predictions, probabilities)."""
+        request = _Request(kind, documents, probabilities)
+        self.queue.put(request)
+        request.done.wait()
+        self.stats.add_request(time.perf_counter() - request.arrived, len(documents), request.error is not None)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0].documents)
+            deadline = batch[0].arrived + self.latency_budget
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.documents)
+            for kind in ['bodies', 'tokens']:
+                requests = [request for request in batch if request.kind == kind]
+                if requests:
+                    self._score(kind, requests)
+
+    def _score(self, kind, requests):
+        start = time.perf_counter()
+        documents = [document for request in requests for document in request.documents]
+        try:
+            predictions, probabilities = self.model.predict(
+                kind, documents, any(request.probabilities for request in requests))
+        except Exception as e:
+            if len(requests) == 1:
+                logging.exception('scoring a request failed')
+                requests[0].error = e
+                requests[0].done.set()
+                return
+            error = e
+        else:
+            error = None
+        if error is not None:
+            # score them one by one, so that only the bad requests fail
+            logging.warning(f'scoring a batch of {len(requests)} requests failed, retrying them one by one')
+            for request in requests:
+                self._score(kind, [request])
+            return
+        self.stats.add_batch(len(documents), time.perf_counter() - start)
+        offset = 0
+        for request in requests:
+            stop = offset + len(request.documents)
+            request.result = (
+                predictions[offset:stop],
+                probabilities[offset:stop] if request.probabilities else None,
+            )
+            offset = stop
+            request.done.set()
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats.snapshot())
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': f'no such endpoint: {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': f'no such endpoint: {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            kinds = [kind for kind in ['bodies', 'tokens'] if isinstance(request, dict) and kind in request]
+            if len(kinds) != 1 or not isinstance(request[kinds[0]], list):
+                raise ValueError('expected a list of either "bodies" or "tokens"')
+            if kinds[0] == 'bodies' and not all(isinstance(body, str) for body in request['bodies']):
+                raise ValueError('"bodies" must be strings')
+            if kinds[0] == 'tokens' and not all(
+                    isinstance(tokens, list) and all(isinstance(token, str) for token in tokens)
+                    for tokens in request['tokens']):
+                raise ValueError('"tokens" must be lists of strings')
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+            return
+        kind = kinds[0]
+        if not request[kind]:
+            response = {'predictions': []}
+            if request.get('probabilities'):
+                response.update(classes=self.server.batcher.model.classes.tolist(), probabilities=[])
+            self._reply(200, response)
+            return
+        try:
+            predictions, probabilities = self.server.batcher.score(
+                kind, request[kind], bool(request.get('probabilities')))
+        except Exception as e:
+            self._reply(500, {'error': repr(e)})
+            return
+        response = {'predictions': predictions.tolist()}
+        if probabilities is not None:
+            response['classes'] = self.server.batcher.model.classes.tolist()
+            response['probabilities'] = probabilities.tolist()
+        self._reply(200, response)
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the client address of a unix socket is empty
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def make_server(model, address, max_batch=64, latency_budget=0.005):
+    """
+    :param model: a fitted pipeline
+    :param address: (host, port) or the path of a unix socket
+    """
+    if isinstance(address, str):
+        server = UnixHTTPServer(address, ScoringHandler)
+    else:
+        server = ThreadingHTTPServer(address, ScoringHandler)
+    server.batcher = MicroBatcher(ScoringModel(model), max_batch, latency_budget)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model', help='pickled fitted pipeline')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', help='listen on this unix socket instead')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--latency-budget', type=float, default=5.0, help='milliseconds')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.model, 'rb') as i_f:
+        model = pickle.load(i_f)
+    address = args.socket or (args.host, args.port)
+    server = make_server(model, address, args.max_batch, args.latency_budget / 1000)
+    logging.info(f'scoring on {address}, entering the pipeline at {server.batcher.model.entries}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Agreement of the exact 'bow' statistics with sampling, see feature_extraction.bow_statistics."""
+import itertools
+
+import numpy as np
+import pytest
+
+from feature_extraction import Document, LifeVectorizer, bow_statistics, count_features
+
+
+def small_document():
+    # frequencies 1 to 6, so that every frequency band occurs
+    words = 'a b b c c c d d d d e e e e e f f f f f f'.split()
+    return Document.from_tokens(np.random.default_rng(0).permutation(words).tolist())
+
+
+def summarize(features):
+    means = features.mean(axis=0)
+    stds = features.std(axis=0)
+    return np.concatenate([means, np.divide(means, stds, out=np.zeros_like(means), where=stds != 0)])
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 10, 20, 21])
+def test_enumeration(size):
+    """Averaging over every possible sample gives the exact statistics."""
+    document = small_document()
+    indices = np.array(list(itertools.combinations(range(len(document)), size)))
+    expected = summarize(count_features(document.ids, indices).astype(np.float64))
+    np.testing.assert_allclose(bow_statistics(document, [size])[0], expected, rtol=1e-10, atol=1e-10)
+
+
+def test_monte_carlo():
+    """The sampled statistics lie within a few standard errors of the exact ones."""
+    rng = np.random.default_rng(1)
+    ids = rng.zipf(1.5, 20000) % 3000
+    sizes = [200, 1000, 4000]
+    samples = 2000
+    exact = bow_statistics(Document.from_tokens(ids), sizes)
+    vectorizer = LifeVectorizer(fragment_sizes=sizes, samples=samples, sample_type='bow', random_state=0)
+    sampled = vectorizer.transform([ids]).reshape(len(sizes), 8)
+    for size, exact_row, sampled_row in zip(sizes, exact, sampled):
+        means, ratios = exact_row[:4], exact_row[4:]
+        stds = np.divide(means, ratios, out=np.zeros_like(means), where=ratios != 0)
+        errors = np.concatenate([stds / np.sqrt(samples), np.sqrt((1 + ratios ** 2 / 2) / samples)])
+        assert np.all(np.abs(sampled_row - exact_row) <= 5 * errors + 1e-12), size